@@ -2,7 +2,11 @@
 
 import re
 import os
+import fcntl
+import ctypes
+import struct
 import executil
+from collections import namedtuple
 from datetime import datetime
 import netinfo
 import ipaddr
@@ -13,77 +17,502 @@ from bootconsole.conf import Conf
 class Error(Exception):
     pass
 
+# MBR partition types
+MBR_EXTENDED = (0x05, 0x0f, 0x85)
+MBR_GPT = 0xee
+
+# GPT GUIDs are stored mixed endian
+def _guid2str(raw):
+    a, b, c = struct.unpack('<IHH', raw[:8])
+    d = raw[8:].encode('hex').upper()
+    return '%08X-%04X-%04X-%s-%s' % (a, b, c, d[:4], d[4:])
+
+# linux/fs.h, linux/blkpg.h
+BLKPG = 0x1269
+BLKPG_RESIZE_PARTITION = 3
+
+class _BlkpgPartition(ctypes.Structure):
+    _fields_ = [('start', ctypes.c_longlong),       # bytes
+                ('length', ctypes.c_longlong),      # bytes
+                ('pno', ctypes.c_int),
+                ('devname', ctypes.c_char * 64),
+                ('volname', ctypes.c_char * 64)]
+
+class _BlkpgIoctlArg(ctypes.Structure):
+    _fields_ = [('op', ctypes.c_int),
+                ('flags', ctypes.c_int),
+                ('datalen', ctypes.c_int),
+                ('data', ctypes.c_void_p)]
+
+def blkpg_resize(device, num, start, length):
+    """Tell the running kernel partition num of disk device now spans
+    length bytes from start, without rereading the whole table (which
+    the kernel refuses while a partition is in use). Raise IOError if
+    the kernel refuses"""
+    part = _BlkpgPartition(start, length, num, '', '')
+    arg = _BlkpgIoctlArg(BLKPG_RESIZE_PARTITION, 0, ctypes.sizeof(part),
+                         ctypes.cast(ctypes.pointer(part), ctypes.c_void_p))
+
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKPG, ctypes.string_at(ctypes.addressof(arg), ctypes.sizeof(arg)))
+    finally:
+        os.close(fd)
+
+def _pread(fd, size, offset):
+    # no os.pread in python 2
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def read_magic(device):
+    """Identify the filesystem or volume on device from its superblock
+    -> 'ext2', 'ext3', 'ext4', 'XFS', 'LVM2', 'swap' or None"""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        head = _pread(fd, 4096, 0)
+        if head[:4] == 'XFSB':
+            return 'XFS'
+
+        # LVM2 label lives in one of the first 4 sectors
+        for sector in range(4):
+            label = head[sector * 512:sector * 512 + 32]
+            if label[:8] == 'LABELONE' and label[24:32] == 'LVM2 001':
+                return 'LVM2'
+
+        if head[4086:4096] in ('SWAPSPACE2', 'SWAP-SPACE'):
+            return 'swap'
+        pagesize = os.sysconf('SC_PAGE_SIZE')
+        if pagesize != 4096 and _pread(fd, 10, pagesize - 10) in ('SWAPSPACE2', 'SWAP-SPACE'):
+            return 'swap'
+
+        # ext superblock at 1024: s_magic at 56, features at 92 (compat),
+        # 96 (incompat)
+        sb = head[1024:1124]
+        if len(sb) == 100 and struct.unpack('<H', sb[56:58])[0] == 0xef53:
+            compat, incompat = struct.unpack('<II', sb[92:100])
+            # extents, 64bit, flex_bg
+            if incompat & (0x40 | 0x80 | 0x200):
+                return 'ext4'
+            # has_journal
+            if compat & 0x4:
+                return 'ext3'
+            return 'ext2'
+    finally:
+        os.close(fd)
+
+    return None
+
+def read_fs_size(device, fs):
+    """Size in bytes of the ext or XFS filesystem on device, from its
+    superblock, None for other kinds"""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        if fs == 'XFS':
+            # big endian sb_blocksize at 4, sb_dblocks at 8
+            blocksize, blocks = struct.unpack('>IQ', _pread(fd, 12, 4))
+            return blocksize * blocks
+        if fs in ('ext2', 'ext3', 'ext4'):
+            sb = _pread(fd, 1024, 1024)
+            blocks = struct.unpack('<I', sb[4:8])[0]
+            log_block_size = struct.unpack('<I', sb[24:28])[0]
+            incompat = struct.unpack('<I', sb[96:100])[0]
+            # 64bit feature: high half of the block count at 0x150
+            if incompat & 0x80:
+                blocks += struct.unpack('<I', sb[0x150:0x154])[0] << 32
+            return blocks * (1024 << log_block_size)
+    finally:
+        os.close(fd)
+
+    return None
+
+class Partition(namedtuple('Partition', 'num start size type kind guid')):
+    """A partition table entry, in logical sectors.
+
+    type is the MBR system id (int) or the GPT type GUID string,
+    kind is 'primary', 'extended', 'logical' or 'gpt',
+    guid is the GPT unique partition GUID (None for MBR)
+    """
+    __slots__ = ()
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+class PartitionTable:
+    """MBR (with extended/logical partitions) or GPT partition table of
+    a disk, read directly from the device.
+
+    Accessible attributes:
+    label		'dos' or 'gpt'
+    sector_size	logical sector size in bytes
+    sectors		disk size in logical sectors, from sysfs
+    last_usable	last sector a partition may use
+    partitions	list of Partition, sorted by number
+    """
+    def __init__(self, disk, device=None):
+        self.disk = disk
+        self.device = device or '/dev/' + disk
+        self.sector_size = int(self._sysfs('queue/logical_block_size', 512))
+        # sysfs size is always in 512 bytes units
+        self.sectors = int(self._sysfs('size')) * 512 / self.sector_size
+        self.partitions = []
+
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            mbr = _pread(fd, 512, 0)
+            if mbr[510:512] != '\x55\xaa':
+                raise Error('Error: no partition table on %s' % self.device)
+
+            entries = self._mbr_entries(mbr)
+            if [ entry for entry in entries if entry[1] == MBR_GPT ]:
+                self._read_gpt(fd)
+            else:
+                self._read_mbr(fd, entries)
+        finally:
+            os.close(fd)
+
+        self.partitions.sort(key=lambda part: part.num)
+
+    def _sysfs(self, attr, default=None):
+        try:
+            return file('/sys/block/%s/%s' % (self.disk, attr)).read().strip()
+        except IOError:
+            if default is None:
+                raise
+            return default
+
+    @staticmethod
+    def _mbr_entries(sector):
+        """-> [ (index, type, start, size) ] of used entries"""
+        entries = []
+        for i in range(4):
+            entry = sector[446 + i * 16:446 + (i + 1) * 16]
+            type = ord(entry[4])
+            start, size = struct.unpack('<II', entry[8:16])
+            if type and size:
+                entries.append((i, type, start, size))
+        return entries
+
+    def _read_mbr(self, fd, entries):
+        self.label = 'dos'
+        self.last_usable = self.sectors - 1
+
+        for i, type, start, size in entries:
+            if type in MBR_EXTENDED:
+                self.partitions.append(Partition(i + 1, start, size, type, 'extended', None))
+                self._read_logical(fd, start)
+            else:
+                self.partitions.append(Partition(i + 1, start, size, type, 'primary', None))
+
+    def _read_logical(self, fd, extended_start):
+        """Walk the EBR chain: first entry is the logical partition
+        (relative to its EBR), second one links to the next EBR
+        (relative to the extended partition)"""
+        num = 5
+        ebr = extended_start
+        seen = set()
+        while ebr not in seen:
+            seen.add(ebr)
+            sector = _pread(fd, 512, ebr * self.sector_size)
+            if sector[510:512] != '\x55\xaa':
+                break
+
+            entries = self._mbr_entries(sector)
+            link = None
+            for i, type, start, size in entries:
+                if type in MBR_EXTENDED:
+                    link = extended_start + start
+                elif i == 0:
+                    self.partitions.append(Partition(num, ebr + start, size, type, 'logical', None))
+                    num += 1
+
+            if link is None:
+                break
+            ebr = link
+
+    def _read_gpt(self, fd):
+        self.label = 'gpt'
+
+        header = _pread(fd, 92, self.sector_size)
+        if header[:8] != 'EFI PART':
+            raise Error('Error: corrupted GPT on %s' % self.device)
+
+        entries_lba, count, entry_size = struct.unpack('<QII', header[72:88])
+        # the backup entries and header sit at the end of the disk, compute
+        # from the current disk size since it may have grown since
+        entries_sectors = (count * entry_size + self.sector_size - 1) / self.sector_size
+        self.last_usable = self.sectors - 2 - entries_sectors
+
+        table = _pread(fd, count * entry_size, entries_lba * self.sector_size)
+        for i in range(count):
+            entry = table[i * entry_size:(i + 1) * entry_size]
+            if len(entry) < 56 or entry[:16] == '\0' * 16:
+                continue
+
+            first, last = struct.unpack('<QQ', entry[32:48])
+            self.partitions.append(Partition(i + 1, first, last - first + 1,
+                                             _guid2str(entry[:16]), 'gpt',
+                                             _guid2str(entry[16:32])))
+
+    def last(self):
+        """Return the data partition ending last on the disk (never an
+        extended container), None if there is none"""
+        parts = [ part for part in self.partitions if part.kind != 'extended' ]
+        if not parts:
+            return None
+        return max(parts, key=lambda part: part.end)
+
+    def container(self, part):
+        """Return the extended partition holding logical part"""
+        for extended in self.partitions:
+            if extended.kind == 'extended' and \
+               extended.start <= part.start < extended.end:
+                return extended
+        return None
+
+    def max_size(self, part):
+        """Largest size part may grow to, keeping its start"""
+        return self.last_usable - part.start + 1
+
+    def free(self, part):
+        """Unallocated sectors after part, up to the end of the disk"""
+        return self.max_size(part) - part.size
+
+class BlockDevice(object):
+    """A block device as seen in sysfs.
+
+    Accessible attributes:
+    name	kernel name (sda, sda1, nvme0n1p2, dm-0)
+    devno	'major:minor'
+    disk	name of the disk holding a partition, None for a disk
+    partition	partition number, None for a disk
+    start	first sector of a partition on its disk
+    size	size in 512 bytes sectors
+    sector_size	logical sector size in bytes
+    holders	names of devices built on this one (dm, md)
+    slaves	names of devices this one is built on
+    dm_name	device-mapper name (vg-lv), None if not a dm device
+    mounts	mount points
+    """
+    def __init__(self, name, path, disk=None):
+        self.name = name
+        self.disk = disk
+        self.devno = self._read(path, 'dev')
+        self.size = int(self._read(path, 'size', 0))
+        self.partition = self._read(path, 'partition')
+        if self.partition is not None:
+            self.partition = int(self.partition)
+            self.start = int(self._read(path, 'start', 0))
+        else:
+            self.start = None
+
+        if disk:
+            queue = os.path.join(os.path.dirname(path), 'queue')
+        else:
+            queue = os.path.join(path, 'queue')
+        self.sector_size = int(self._read(queue, 'logical_block_size', 512))
+
+        self.holders = self._list(path, 'holders')
+        self.slaves = self._list(path, 'slaves')
+        self.dm_name = self._read(path, 'dm/name')
+        self.is_hardware = os.path.exists(os.path.join(path, 'device'))
+        self.mounts = []
+
+    @staticmethod
+    def _read(path, attr, default=None):
+        try:
+            return file(os.path.join(path, attr)).read().strip()
+        except IOError:
+            return default
+
+    @staticmethod
+    def _list(path, attr):
+        try:
+            return sorted(os.listdir(os.path.join(path, attr)))
+        except OSError:
+            return []
+
+    @property
+    def device(self):
+        return '/dev/' + self.name
+
+    @property
+    def is_partition(self):
+        return self.partition is not None
+
+    def __repr__(self):
+        return "BlockDevice(%s)" % self.name
+
+class BlockTopology:
+    """Disks, partitions and stacked devices (dm, md) with their sizes,
+    holder/slave links and mount points, from one scan of /sys/block and
+    /proc/self/mountinfo. Lookups by name are dict lookups, refresh()
+    rereads only the devices asked for.
+    """
+    SYS_BLOCK = '/sys/block'
+    MOUNTINFO = '/proc/self/mountinfo'
+
+    def __init__(self):
+        self.devices = {}
+        self.refresh()
+
+    def _scan_disk(self, name):
+        """(Re)read disk name and its partitions"""
+        for partition in self.partitions(name):
+            del self.devices[partition.name]
+
+        path = os.path.join(self.SYS_BLOCK, name)
+        if not os.path.isdir(path):
+            self.devices.pop(name, None)
+            return
+
+        self.devices[name] = BlockDevice(name, path)
+        # partitions are subdirectories of their disk, with a partition file
+        for entry in os.listdir(path):
+            partpath = os.path.join(path, entry)
+            if os.path.exists(os.path.join(partpath, 'partition')):
+                self.devices[entry] = BlockDevice(entry, partpath, name)
+
+    def _read_mounts(self):
+        mounts = {}
+        for line in file(self.MOUNTINFO).readlines():
+            fields = line.split()
+            # mount point escapes spaces and the like as \ooo
+            mountpoint = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[4])
+            mounts.setdefault(fields[2], []).append(mountpoint)
+
+        for device in self.devices.values():
+            device.mounts = mounts.get(device.devno, [])
+
+    def refresh(self, names=None):
+        """Rescan all devices, or only disks <names> (with their
+        partitions), e.g. after a rescan or a partition table change"""
+        if names is None:
+            self.devices = {}
+            names = os.listdir(self.SYS_BLOCK)
+
+        for name in names:
+            self._scan_disk(name)
+        self._read_mounts()
+
+    def get(self, name):
+        """Return the BlockDevice called name (sda1 or /dev/sda1), or None"""
+        if name.startswith('/dev/'):
+            name = name[5:]
+        return self.devices.get(name)
+
+    def disks(self):
+        """Return physical disks (not loop, ram, dm...), sorted by name"""
+        return sorted([ device for device in self.devices.values()
+                        if not device.is_partition and device.is_hardware ],
+                      key=lambda device: device.name)
+
+    def partitions(self, disk):
+        """Return partitions of disk, sorted by number"""
+        return sorted([ device for device in self.devices.values()
+                        if device.disk == disk ],
+                      key=lambda device: device.partition)
+
+    def partition(self, disk, num):
+        for device in self.partitions(disk):
+            if device.partition == num:
+                return device
+        return None
+
+    def holders(self, name):
+        """Return devices stacked on name, recursively (partition ->
+        dm linear of an LV...), nearest first"""
+        chain = []
+        pending = list(self.get(name).holders)
+        while pending:
+            device = self.get(pending.pop(0))
+            if device is None or device in chain:
+                continue
+            chain.append(device)
+            pending.extend(device.holders)
+        return chain
+
 class BlockDevices:
 
     def __init__(self):
+        self.topology = BlockTopology()
         self.disks = self.get_disks()
         # Corresponding expand command associated with the partition type
         # trailing space is important, do not strip it.
         self.resize_cmd_choice = { 'LVM2' : 'pvresize ',
+                              'ext2' : 'resize2fs ',
                               'ext3' : 'resize2fs ',
                               'ext4' : 'resize2fs ',
                               'XFS' : 'xfs_growfs ',
                               'swap' : '',
                               'extended'  : 'echo "Do not support extended resize. Please call your Syleps SIC."'}
-
-        self.partition_system_id = { 'LVM2' : '8e',
-                     'ext3' : '83',
-                     'ext4' : '83',
-                     'XFS'  : '83',
-                     'swap' : '82',
-                     'extended' : '5' }
         
     def detect_fs(self, part):
                 try:
-                    type = executil.getoutput('/usr/bin/file -s '+part+' | grep -Eo "LVM2|ext[2-4]|XFS|swap|extended"')
-                    return type
-                except:
+                    fs = read_magic(part)
+                except OSError, e:
+                    raise Error('Error: FS not compatible (%s)' % e)
+
+                if not fs:
                     raise Error('Error: FS not compatible')
+                return fs
 
-    @staticmethod
-    def get_disks():
+    def get_disks(self):
         disks = []
-        for line in file('/proc/partitions').readlines():
-            line = line.strip()
-            if not line or line.startswith('major'):
-                continue
-
+        for disk in self.topology.disks():
             # size in MB
-            size = int(line.split()[2])
-            size = size / 1024
-
-            elt = line.split()[3]
-            if not re.search(r'\d+$', elt) and not elt.startswith('dm'):
-                disks.append((elt, "%d MB" % size))
+            disks.append((disk.name, "%d MB" % (disk.size / 2048)))
 
         return disks
 
-    def get_lastpart(self, disk):
+    def part_device(self, device, num):
+        partition = self.topology.partition(os.path.basename(device), num)
+        if partition:
+            return partition.device
 
+        # not known to the kernel yet: /dev/sda1 but /dev/nvme0n1p1
+        if device[-1].isdigit():
+            return '%sp%d' % (device, num)
+        return '%s%d' % (device, num)
+
+    def get_lastpart(self, disk):
+        """Describe the partition ending last on disk, the one to grow.
+        Sizes are in sectors, as strings. 'container' is the number of
+        the extended partition to grow first for a logical partition."""
         device = '/dev/'+disk
-        ret = {}
+        table = PartitionTable(disk)
+        part = table.last()
+        if part is None:
+            return {}
 
-        for line in file('/proc/partitions').readlines():
-            try:
-                part = int(re.search(disk+r'(\d+)$', line).group(1))
-            except AttributeError:
-                 continue
-
-            if part > 4:
-                raise Error("Error: Bootconsole doesn't manage yet logical partitions.")
-
-            lastpart_indice = str(part)
-            fs = self.detect_fs(device+lastpart_indice)
-            part_id = self.partition_system_id[fs]
-            resize_cmd = self.resize_cmd_choice[fs]+device+lastpart_indice
-            max_size = self.get_max_size(device, lastpart_indice)
-            ret = {'num': lastpart_indice, 'type': part_id, 'cmd': resize_cmd, 'max_size': max_size}
+        partdev = self.part_device(device, part.num)
+        fs = self.detect_fs(partdev)
+        if table.label == 'gpt':
+            part_id = part.type
+        else:
+            part_id = '%x' % part.type
+        resize_cmd = self.resize_cmd_choice[fs]+partdev
+
+        ret = {'num': str(part.num), 'type': part_id, 'cmd': resize_cmd,
+               'max_size': str(table.max_size(part)), 'label': table.label,
+               'start': str(part.start), 'size': str(part.size),
+               'free': str(table.free(part)), 'fs': fs, 'guid': part.guid,
+               'sector_size': table.sector_size, 'container': None}
+
+        extended = table.container(part)
+        if extended:
+            ret['container'] = str(extended.num)
+            ret['container_type'] = '%x' % extended.type
+            ret['container_max_size'] = str(table.max_size(extended))
         return ret
 
     def rescan_disks(self):
         for disk in self.disks:
-            device = '/dev/' + disk[0]
-            executil.system('/bin/echo "1" > /sys/block/'+disk[0]+'/device/rescan')
+            fh = file('/sys/block/'+disk[0]+'/device/rescan', 'w')
+            fh.write('1')
+            fh.close()
+        executil.clear_cache()
+        self.topology.refresh([ disk[0] for disk in self.disks ])
 
         rescanned_disks = self.get_disks()
         ret_disks = []
@@ -97,15 +526,271 @@ class BlockDevices:
             i += 1
         return ret_disks
 
-    def get_max_size(self, device, lastpart):
-        # It is important to use sector as unit and not cylinder by default 'cause cylinder
-        # doesn't have the necessary granulirity to correctly address partition.
-        cmd = 'sfdisk --no-reread -uS -L -N'+lastpart+' '+device+' -L -uS << EOF 2>&1\n,999999999999,'+'\nEOF\n'
+    def write_partition_table(self, disk, lastpart):
+        """Grow lastpart (see get_lastpart) to its max_size on disk"""
+        device = '/dev/' + disk
+        num = lastpart['num']
+        if lastpart['label'] == 'gpt':
+            # Move the backup GPT to the new end of disk, then recreate the
+            # partition at the same start with the same type and GUID
+            end = int(lastpart['start']) + int(lastpart['max_size']) - 1
+            commands = [(['sgdisk', '-e', device], None),
+                        (['sgdisk', '-d', num,
+                          '-n', '%s:%s:%d' % (num, lastpart['start'], end),
+                          '-t', '%s:%s' % (num, lastpart['type']),
+                          '-u', '%s:%s' % (num, lastpart['guid']), device], None)]
+        else:
+            commands = []
+            resizes = [(num, lastpart['max_size'], lastpart['type'])]
+            # a logical partition can't go past its extended partition
+            if lastpart['container']:
+                resizes.insert(0, (lastpart['container'], lastpart['container_max_size'],
+                                   lastpart['container_type']))
+
+            for num, size, type in resizes:
+                # It is important to use sector as unit and not cylinder by default 'cause cylinder
+                # doesn't have the necessary granulirity to correctly address partition.
+                sfdisk_cmd = ['sfdisk', '--no-reread', '-uS', '-L', '-N'+num, device]
+                sfdisk_script = ','+size+','+type+'\n'
+                commands.append((sfdisk_cmd, sfdisk_script))
+
+        try:
+            for command, input in commands:
+                executil.getoutput_popen(command, input=input)
+        except executil.ExecError, e:
+            raise Error("Error: could not write partition table of %s: %s" % (device, e))
+        finally:
+            executil.clear_cache()
+
+        # don't let the kernel be given a size the table on disk doesn't have
+        sizes = dict([ (part.num, part.size) for part in PartitionTable(disk, device).partitions ])
+        if sizes.get(int(lastpart['num'])) != int(lastpart['max_size']):
+            raise Error("Error: partition table of %s was not updated" % device)
+
+    def resize_in_kernel(self, disk, lastpart):
+        """Make the running kernel use the new size of lastpart, through
+        BLKPG or else partx. Return True if the kernel sees it"""
+        device = '/dev/' + disk
+        num = int(lastpart['num'])
+        sector_size = lastpart['sector_size']
+        try:
+            blkpg_resize(device, num, int(lastpart['start']) * sector_size,
+                         int(lastpart['max_size']) * sector_size)
+        except IOError:
+            try:
+                executil.getoutput(['partx', '-u', '--nr', str(num), device])
+            except executil.ExecError:
+                pass
+        executil.clear_cache()
 
-        output = executil.getoutput_popen(cmd, careabouterrors=False).split('\n')
-        for line in output:
-            if line.startswith('Warning'):
-                maximum = re.search(r'\((\d+)\)$', line).group(1)
-                return maximum
+        self.topology.refresh([disk])
+        partition = self.topology.partition(disk, num)
+        # topology sizes are in 512 bytes sectors
+        return partition is not None and \
+               partition.size * 512 == int(lastpart['max_size']) * sector_size
+
+    def grow_live(self, disk, lastpart):
+        """Grow the PV or filesystem on lastpart while in use.
+        Return False if that can't be done online, raise ExecError if
+        the resize tool fails"""
+        partition = self.topology.partition(disk, int(lastpart['num']))
+        fs = lastpart['fs']
+        if fs == 'LVM2':
+            command = ['pvresize', partition.device]
+        elif fs in ('ext2', 'ext3', 'ext4'):
+            command = ['resize2fs', partition.device]
+        elif fs == 'XFS':
+            # xfs only grows mounted, through its mount point
+            if not partition.mounts:
+                return False
+            command = ['xfs_growfs', partition.mounts[0]]
+        else:
+            # nothing to grow inside (swap)
+            return True
+
+        return _run(command)
+
+    def _grow_partition(self, disk, lastpart):
+        self.write_partition_table(disk, lastpart)
+        return self.resize_in_kernel(disk, lastpart)
+
+    def _lvs(self, vg_name):
+        """Logical volumes of vg_name, with their BlockDevice if active"""
+        lvs = _lvm_report('lvs', LV_FIELDS, vg_name)
+        for lv in lvs:
+            lv['device'] = None
+            devno = '%s:%s' % (lv['lv_kernel_major'], lv['lv_kernel_minor'])
+            for device in self.topology.devices.values():
+                if device.devno == devno:
+                    lv['device'] = device
+        return lvs
+
+    def grow_targets(self, disk):
+        """Return [(mount point, 'vg/lv')] of mounted logical volumes the
+        last partition of disk can give space to"""
+        lastpart = self.get_lastpart(disk)
+        if not lastpart or lastpart['fs'] != 'LVM2':
+            return []
+
+        partition = self.topology.partition(disk, int(lastpart['num']))
+        pv = _lvm_report('pvs', PV_FIELDS, partition.device)[0]
+        targets = []
+        for lv in self._lvs(pv['vg_name']):
+            if lv['device'] and lv['device'].mounts:
+                targets.append((lv['device'].mounts[0], '%s/%s' % (lv['vg_name'], lv['lv_name'])))
+        return targets
+
+    def plan_grow(self, disk, mountpoint=None):
+        """Plan growing everything between the last partition of disk and
+        the filesystem on top: partition -> PV -> VG -> the LV mounted on
+        mountpoint -> filesystem, or partition -> filesystem without LVM.
+        Only steps which have something to grow are planned. mountpoint
+        may be None if the volume group has a single mounted LV."""
+        lastpart = self.get_lastpart(disk)
+        if not lastpart:
+            raise Error("Error: no partition to grow on /dev/%s" % disk)
+
+        partition = self.topology.partition(disk, int(lastpart['num']))
+        sector_size = lastpart['sector_size']
+        part_before = int(lastpart['size']) * sector_size
+        part_after = int(lastpart['max_size']) * sector_size
+
+        plan = GrowPlan()
+        if int(lastpart['free']):
+            step = plan.add("Partition %s" % partition.device, part_before, part_after,
+                            self._grow_partition, disk, lastpart)
+            # the kernel may refuse while the disk is in use
+            step.reboot_fallback = True
+
+        if lastpart['fs'] != 'LVM2':
+            if lastpart['fs'] == 'XFS' and not partition.mounts:
+                # xfs_growfs works on mounted filesystems only
+                raise Error("Error: mount the XFS filesystem on %s to grow it" % partition.device)
+            fs_size = read_fs_size(partition.device, lastpart['fs'])
+            # less than a block left is as good as full
+            if fs_size is not None and part_after - fs_size >= 65536:
+                plan.add("%s on %s" % (lastpart['fs'], partition.device), fs_size,
+                         part_after, self.grow_live, disk, lastpart)
+            return plan
+
+        pv = _lvm_report('pvs', PV_FIELDS, partition.device)[0]
+        vg = _lvm_report('vgs', VG_FIELDS, pv['vg_name'])[0]
+        extent = int(vg['vg_extent_size'])
+        pv_size = int(pv['pv_size'])
+        pv_after = (part_after - int(pv['pe_start'])) / extent * extent
+        growth = max(0, pv_after - pv_size)
+        if growth:
+            plan.add("Physical volume %s" % partition.device, pv_size, pv_after,
+                     self.grow_live, disk, lastpart)
+
+        vg_free = int(vg['vg_free']) + growth
+        lvs = [ lv for lv in self._lvs(pv['vg_name'])
+                if lv['device'] and lv['device'].mounts and
+                   (mountpoint is None or mountpoint in lv['device'].mounts) ]
+        if not lvs:
+            return plan
+        if len(lvs) > 1:
+            raise Error("Error: choose which mounted volume of %s to grow" % pv['vg_name'])
+
+        lv = lvs[0]
+        lv_size = int(lv['lv_size'])
+        name = "%s/%s" % (lv['vg_name'], lv['lv_name'])
+        if vg_free:
+            plan.add("Logical volume %s" % name, lv_size, lv_size + vg_free,
+                     _run, ['lvextend', '-l', '+100%FREE', lv['lv_path']])
+
+        fs = read_magic(lv['lv_path'])
+        if fs == 'XFS':
+            command = ['xfs_growfs', lv['device'].mounts[0]]
+        elif fs in ('ext2', 'ext3', 'ext4'):
+            command = ['resize2fs', lv['lv_path']]
+        else:
+            return plan
+
+        fs_size = read_fs_size(lv['lv_path'], fs)
+        if lv_size + vg_free - fs_size >= 65536:
+            plan.add("%s on %s" % (fs, lv['device'].mounts[0]), fs_size, lv_size + vg_free,
+                     _run, command)
+
+        return plan
+
+PV_FIELDS = ('pv_name', 'vg_name', 'pv_size', 'pv_free', 'pe_start')
+VG_FIELDS = ('vg_name', 'vg_size', 'vg_free', 'vg_extent_size')
+LV_FIELDS = ('vg_name', 'lv_name', 'lv_path', 'lv_size', 'lv_kernel_major', 'lv_kernel_minor')
+
+def _lvm_report(command, fields, *args):
+    """Run an lvm report command (pvs, vgs, lvs) -> [ {field: value} ],
+    sizes in bytes. Reports are cached until the next change"""
+    try:
+        output = executil.getoutput_cached([command, '--noheadings', '--nosuffix', '--units', 'b',
+                                     '--separator', ':', '-o', ','.join(fields)] + list(args))
+    except executil.ExecError, e:
+        raise Error('Error: %s' % e)
+
+    rows = []
+    for line in output.splitlines():
+        line = line.strip()
+        if line:
+            rows.append(dict(zip(fields, line.split(':'))))
+    if not rows:
+        raise Error('Error: %s found nothing for %s' % (command, ' '.join(args)))
+    return rows
+
+def _run(command):
+    try:
+        executil.getoutput(command)
+    finally:
+        executil.clear_cache()
+    return True
+
+class GrowStep:
+    """One step of a GrowPlan: sizes in bytes before and after, and the
+    action doing it, returning False if it could not be done online.
+    After a failed run, refused tells the action returned False and
+    error says why"""
+    def __init__(self, description, before, after, action, *args):
+        self.description = description
+        self.before = before
+        self.after = after
+        self.action = action
+        self.args = args
+        self.reboot_fallback = False
+        self.refused = False
+        self.error = None
+
+    def __str__(self):
+        return "%s: %d MB -> %d MB" % (self.description, self.before / 1048576,
+                                       self.after / 1048576)
+
+class GrowPlan:
+    """Ordered steps growing storage, see BlockDevices.plan_grow"""
+    def __init__(self):
+        self.steps = []
+
+    def add(self, description, before, after, action, *args):
+        step = GrowStep(description, before, after, action, *args)
+        self.steps.append(step)
+        return step
+
+    def __str__(self):
+        return "\n".join([ str(step) for step in self.steps ])
+
+    def run(self, progress=None):
+        """Run steps in order, stopping at the first failure.
+        progress(percent, text) is called before each step.
+        Return the step which failed (see its error), None on success"""
+        for i, step in enumerate(self.steps):
+            if progress:
+                progress(100 * i / len(self.steps), "%d/%d %s" % (i + 1, len(self.steps), step))
+            try:
+                if not step.action(*step.args):
+                    step.refused = True
+                    step.error = "refused online"
+                    return step
+            except (Error, executil.ExecError), e:
+                step.error = str(e)
+                return step
 
-        raise Error('Error, contact Syleps support about that please: %s' % str(output))
\ No newline at end of file
+        if progress:
+            progress(100, "done")
+        return None
@@ -2,35 +2,251 @@
 # Modified and adapted by Romain Forlot.
 # Copyright (c) 2014 Romain Forlot <romain.forlot@syleps.fr> - all rights reserved
 
-import re
 import os
 import executil
 import ifutil
 import ipaddr
+import filecache
+import fileutil
+import hosts
 
 class Error(Exception):
     pass
 
+class PathResolver:
+    """Finds configuration files in a list of directories.
+
+    Results are memoized, misses included. A found path is dropped once
+    the file is gone, and a miss is forgotten as soon as one of the
+    directories changes (e.g. sic_seal creating validated) or on
+    invalidate(). Accessible attributes:
+
+    search_path	directories looked into, in order
+    resolved	filename -> absolute path
+    missing	filename -> signatures of search_path directories when
+    		filename was not found
+    """
+    def __init__(self, search_path=("/etc", "conf", "/etc/bootconsole")):
+        self.set_search_path(search_path)
+
+    def set_search_path(self, search_path):
+        self.search_path = list(search_path)
+        self.invalidate()
+
+    def invalidate(self, filename=None):
+        if filename is None:
+            self.resolved = {}
+            self.missing = {}
+        else:
+            self.resolved.pop(filename, None)
+            self.missing.pop(filename, None)
+
+    def _signatures(self):
+        signatures = []
+        for dir in self.search_path:
+            try:
+                signatures.append(filecache.FileCache.signature(dir))
+            except OSError:
+                signatures.append(None)
+        return signatures
+
+    def _search(self, filename):
+        self.invalidate(filename)
+        signatures = self._signatures()
+        for dir in self.search_path:
+            path = os.path.join(dir, filename)
+            if os.path.exists(path):
+                self.resolved[filename] = os.path.abspath(path)
+                return self.resolved[filename]
+
+        self.missing[filename] = signatures
+        return None
+
+    def _lookup(self, filename):
+        path = self.resolved.get(filename)
+        if path is not None and os.path.exists(path):
+            return path
+
+        if filename in self.missing and self.missing[filename] == self._signatures():
+            return None
+
+        return self._search(filename)
+
+    def resolve(self, filename):
+        path = self._lookup(filename)
+        if path is None:
+            raise Error('could not find configuration file: %s in %s' %
+                        (filename, ':'.join(self.search_path)))
+        return path
+
+    def preflight(self, filenames):
+        """Resolve filenames at once, return those which are missing"""
+        return [ filename for filename in filenames if self._search(filename) is None ]
+
+resolver = PathResolver()
+
 def path(filename):
     '''
-    Try to find file in some default dir
+    Try to find file in some default dir, see PathResolver
     Return abs path it finds.
     '''
-    for dir in ("/etc", "conf", "/etc/bootconsole"):
-        path = os.path.join(dir, filename)
-        if os.path.exists(path):
-            return path
+    return resolver.resolve(filename)
+
+class MultiMap:
+    """Ordered multimap of configuration lines.
+
+    Every line of the file keeps its slot, comments included (their key
+    is None). Slots of deleted lines are left empty and reclaimed once
+    they outnumber the live ones, so lookups, deletes and in-place
+    replaces don't scan the whole file.
+    """
+    def __init__(self, entries=()):
+        self.slots = []         # [key, line] or None once deleted
+        self.index = {}         # key -> [slot numbers], in file order
+        self.deleted = 0
+        for key, line in entries:
+            self.append(key, line)
+
+    def append(self, key, line):
+        if key is not None:
+            self.index.setdefault(key, []).append(len(self.slots))
+        self.slots.append([key, line])
+
+    def get(self, key):
+        return [ self.slots[slot][1] for slot in self.index.get(key, []) ]
+
+    def delete(self, key):
+        for slot in self.index.pop(key, []):
+            self.slots[slot] = None
+            self.deleted += 1
+
+        if self.deleted > len(self.slots) / 2:
+            self._compact()
+
+    def replace(self, key, line):
+        """Replace first line of key in place, drop the others"""
+        slots = self.index.get(key)
+        if not slots:
+            return self.append(key, line)
+
+        self.slots[slots[0]][1] = line
+        for slot in slots[1:]:
+            self.slots[slot] = None
+            self.deleted += 1
+        del slots[1:]
+
+    def insert(self, pos, key, line):
+        """Insert before the pos-th line having a key"""
+        slot = len(self.slots)
+        for i, entry in enumerate(self.slots):
+            if entry is not None and entry[0] is not None:
+                if pos == 0:
+                    slot = i
+                    break
+                pos -= 1
+
+        self.slots.insert(slot, [key, line])
+        self._compact()
+
+    def _compact(self):
+        slots = [ entry for entry in self.slots if entry is not None ]
+        self.slots = []
+        self.index = {}
+        self.deleted = 0
+        for key, line in slots:
+            self.append(key, line)
+
+    def lines(self, comments=True):
+        return [ entry[1] for entry in self.slots
+                 if entry is not None and (comments or entry[0] is not None) ]
+
+class ParamList:
+    """Mutable list view of the lines of a MultiMap having a key, i.e.
+    comments left out. Changes go through to the MultiMap"""
+    def __init__(self, params):
+        self.params = params
+
+    @staticmethod
+    def key(line):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            return None
+        return fields[0]
+
+    def _slots(self):
+        return [ slot for slot, entry in enumerate(self.params.slots)
+                 if entry is not None and entry[0] is not None ]
+
+    def _lines(self):
+        return self.params.lines(comments=False)
+
+    def __len__(self):
+        return len(self._slots())
+
+    def __iter__(self):
+        return iter(self._lines())
+
+    def __contains__(self, line):
+        return line in self._lines()
+
+    def __getitem__(self, i):
+        return self._lines()[i]
+
+    def __setitem__(self, i, line):
+        self.params.slots[self._slots()[i]] = [self.key(line), line]
+        self.params._compact()
+
+    def __delitem__(self, i):
+        self.params.slots[self._slots()[i]] = None
+        self.params._compact()
+
+    def __eq__(self, other):
+        return self._lines() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._lines())
+
+    def index(self, line):
+        return self._lines().index(line)
+
+    def append(self, line):
+        self.params.append(self.key(line), line)
+
+    def insert(self, pos, line):
+        self.params.insert(pos, self.key(line), line)
 
-    raise Error('could not find configuration file: %s' % path)
+    def remove(self, line):
+        del self[self.index(line)]
+
+class Conf(object):
+    # written by write_conf, not part of the configuration itself
+    MARKERS = ("# Syleps configuration",
+               "# Don't modifiy this part !",
+               "# End Syleps")
 
-class Conf:
     def __init__(self, conf_file, sep=None, merge=False):
-        self.param = []
+        self.params = MultiMap()
         self.sep = sep
         self.merge = merge
+        # whether the last write_conf/set_hosts actually wrote the file,
+        # and what was left untouched
+        self.changed = False
+        self.skipped = []
         self.conf_file = path(conf_file)
         self._load_conf()
 
+    def _get_param(self):
+        return ParamList(self.params)
+
+    def _set_param(self, lines):
+        self.params = MultiMap([ (ParamList.key(line), line) for line in lines ])
+
+    param = property(_get_param, _set_param,
+                     doc="Configuration lines, without comments, see ParamList")
+
     @staticmethod
     def is_conf_already_configured(conf_file):
         fh = open (conf_file, 'r')
@@ -40,74 +256,82 @@ class Conf:
                 
         return False
 
-    def _load_conf(self):
-        if not os.path.exists(self.conf_file):
-            return
-
-        for line in file(self.conf_file).readlines():
+    @classmethod
+    def _parse_conf(self, conf_file):
+        """-> ((key, line), ...), key is None for comments"""
+        entries = []
+        for line in file(conf_file).readlines():
             line = line.strip()
 
-            if not line or line.startswith("#"):
+            if not line or line in self.MARKERS:
                 continue
 
-            self.param.append(line)
+            if line.startswith("#"):
+                entries.append((None, line))
+            else:
+                entries.append((line.split()[0], line))
+
+        return tuple(entries)
+
+    def _load_conf(self):
+        if not os.path.exists(self.conf_file):
+            return
+
+        for key, line in filecache.parse(self.conf_file, self._parse_conf):
+            self.params.append(key, line)
 
     def del_param(self, key):
-        for elt in self.param:
-            if elt.startswith(key):
-                self.param.remove(elt)
-        for elt in self.param:
-            if elt.startswith(key):
-                self.param.remove(elt)
+        self.params.delete(key)
 
     def get_param(self, key, bare=False):
         ret = []
-        for elt in self.param:
-            if elt.split()[0] == key:
-                if bare == False:
-                    try:
-                        ret.append(elt.split(self.sep, 1)[1])
-                    except IndexError:
-                        ret.append('')
-                else:
-                    ret.append(elt)
+        for elt in self.params.get(key):
+            if bare == False:
+                try:
+                    ret.append(elt.split(self.sep, 1)[1])
+                except IndexError:
+                    ret.append('')
+            else:
+                ret.append(elt)
 
         if len(ret) == 1:
             ret = ret[0]
             
         return ret
 
+    def _format(self, key, val):
+        try:
+            return key + self.sep + val
+        except TypeError:
+            return key + ' ' + val
+
     # Set a parameter at a given position or a the end by default.
     # That does not replace an existing parameter but add a new one.
     def set_param(self, key, val, index=None):
         if index == None :
-            try:
-                line = key + self.sep + val
-            except TypeError:
-                line = key + ' ' + val
-            self.param.append(line)
+            self.params.append(key, self._format(key, val))
         else:
-            try:
-                self.param.insert(index, key + self.sep + val)
-            except TypeError:
-                self.param.insert(index, key + ' ' + val)
+            self.params.insert(index, key, self._format(key, val))
 
+    # Replace a parameter where it stands, or add it at the end
     def change_param(self, key, val):
-        self.del_param(key)
-        self.set_param(key, val)
+        self.params.replace(key, self._format(key, val))
 
     def write_conf(self):
+        content = ["# Syleps configuration\n",
+                   "# Don't modifiy this part !\n"]
+        content.extend([ elt + "\n" for elt in self.params.lines() ])
+        content.append("# End Syleps\n")
+
+        self.skipped = []
         try:
-            fh = open(self.conf_file, 'w')
-            fh.write("# Syleps configuration\n")
-            fh.write("# Don't modifiy this part !\n")
-            for elt in self.param:
-                fh.write(elt + "\n")
-            fh.write("# End Syleps\n")
-            fh.close()
+            self.changed = fileutil.write_if_changed(self.conf_file, "".join(content))
         except:
             return "Something goes wrong when attempting to write file."
 
+        if not self.changed:
+            self.skipped.append(self.conf_file)
+
     def set_hosts(self, ip, hostname, aliases, peer_hostname, peer_aliases, peer_ip):
         # Set domain name if not provided
         if not '.' in hostname:
@@ -115,31 +339,9 @@ class Conf:
         if not '.' in peer_hostname:
             peer_hostname = peer_hostname + ".sydel.univers"
 
-        ifutil.NetworkSettings().set_hostname(hostname)
-
-        all_aliases = aliases+peer_aliases
-        original_content = []
-        is_custom = False
-        fh = open(self.conf_file, 'r')
-        for line in fh.readlines():
-            for pattern in all_aliases:
-                    if re.search(pattern, line) is not None:
-                        continue
-            if line.startswith('# End Syleps'):
-                is_custom = False
-                continue
-            if is_custom == True:
-                continue
-            if line.startswith('# Syleps configuration'):
-                is_custom = True
-                continue
-            original_content.append(line)
-
-        fh.close()
-
-        fh = open(self.conf_file, 'w')
-        fh.writelines(original_content)
-        fh.close()
+        settings = ifutil.NetworkSettings()
+        hostname_changed = settings.set_hostname(hostname)
+        self.skipped = list(settings.skipped)
 
         shortname = ''
         peer_shortname = ''
@@ -148,35 +350,93 @@ class Conf:
         if not peer_hostname.split('.', 1)[0] == peer_hostname:
             peer_shortname = peer_hostname.split('.', 1)[0] + '\t'
 
-        fh = open(self.conf_file, 'w')
-        fh.writelines(original_content)
-        fh.write("# Syleps configuration\n")
-        fh.write("# Don't modify this part !\n")
-        fh.write("# @IP\tFQDN\tShortname\tOptionals aliases\tMandatory component specification\n")
-        fh.write(ip + "\t" + hostname + "\t" + shortname + '\t'.join(aliases) +"# LOCAL\n")
-        fh.write(peer_ip + "\t" + peer_hostname + "\t" + peer_shortname + '\t'.join(peer_aliases)+"# PARTNER\n")
-        fh.write("# End Syleps hosts\n")
-        fh.close()
+        block = [
+            "# Syleps configuration\n",
+            "# Don't modify this part !\n",
+            "# @IP\tFQDN\tShortname\tOptionals aliases\tMandatory component specification\n",
+            ip + "\t" + hostname + "\t" + shortname + '\t'.join(aliases) +"# LOCAL\n",
+            peer_ip + "\t" + peer_hostname + "\t" + peer_shortname + '\t'.join(peer_aliases)+"# PARTNER\n",
+            "# End Syleps hosts\n"]
+
+        fh = file(self.conf_file)
+        try:
+            content = "".join(hosts.rewrite(fh, block))
+        finally:
+            fh.close()
+
+        if fileutil.write_if_changed(self.conf_file, content):
+            self.changed = True
+        else:
+            self.changed = hostname_changed
+            self.skipped.append(self.conf_file)
 
     def get_host(self, host):
-        for line in self.param:
-            if host in line:
-                if '#' in line:
-                    elt, comment = line.split('#')
-                    elt = elt.strip()
-                    comment = comment.strip()
-                else:
-                    elt = line.strip()
-                    comment = ''
-                v = elt.split()[1:]
-                aliases = v[2:-1]
-                return { 'hostname': v[0],
-                        'ip' : elt.split()[0],
-                        'aliases': ','.join(aliases),
-                        'comment' : comment,
+        """Look host up by exact role (LOCAL, PARTNER), IP, hostname or
+        alias in the hosts index of conf_file"""
+        entry = hosts.index(self.conf_file).lookup(host)
+        if entry is None:
+            return { 'hostname': '',
+                     'ip': '',
+                     'aliases': '',
+                     'comment': '',
+                    }
+
+        aliases = entry.names[2:-1]
+        return { 'hostname': entry.hostname,
+                 'ip' : entry.ip,
+                 'aliases': ','.join(aliases),
+                 'comment' : entry.comment,
                 }
-        return { 'hostname': '',
-                 'ip': '',
-                 'aliases': '',
-                 'comment': '',
-                }
\ No newline at end of file
+
+
+def benchmark(lines=20000, lookups=2000):
+    """Compare the former line scan with MultiMap on a large chrony.conf
+    like file"""
+    import time
+    import tempfile
+
+    fh = tempfile.NamedTemporaryFile(suffix='.conf')
+    for i in range(lines):
+        if i % 4 == 0:
+            fh.write("# server pool %d\n" % i)
+        else:
+            fh.write("server 10.%d.%d.%d iburst\n" % (i >> 16, (i >> 8) & 255, i & 255))
+    fh.write("driftfile /var/lib/chrony/drift\n")
+    fh.write("makestep 1.0 3\n")
+    fh.flush()
+
+    def scan_get(param, key):
+        return [ elt.split(None, 1)[1] for elt in param if elt.split()[0] == key ]
+
+    def scan_change(param, key, val):
+        for elt in param[:]:
+            if elt.startswith(key):
+                param.remove(elt)
+        param.append(key + ' ' + val)
+
+    conf = Conf(fh.name)
+    param = list(conf.param)
+    keys = ('driftfile', 'makestep', 'rtcsync')
+
+    start = time.time()
+    for i in range(lookups):
+        scan_get(param, keys[i % 3])
+    for i in range(lookups / 10):
+        scan_change(param, keys[i % 3], str(i))
+    scanned = time.time() - start
+
+    start = time.time()
+    for i in range(lookups):
+        conf.get_param(keys[i % 3])
+    for i in range(lookups / 10):
+        conf.change_param(keys[i % 3], str(i))
+    indexed = time.time() - start
+
+    fh.close()
+
+    print "%d lines, %d lookups + %d changes" % (lines, lookups, lookups / 10)
+    print "  line scan: %.3f s" % scanned
+    print "  multimap:  %.3f s" % indexed
+
+if __name__ == "__main__":
+    benchmark()
@@ -64,7 +64,7 @@ program) and you should be safe.
 """
 
 #from __future__ import nested_scopes
-import sys, os, tempfile, random, string, re, types
+import sys, os, tempfile, random, string, re, types, select, signal, errno
 
 
 # Python < 2.3 compatibility
@@ -812,6 +812,36 @@ class Dialog:
 
         return (exit_code, child_output)
 
+    def _wait_for_wakeup(self, child_pid, child_rfd, wakeup):
+        """Wait for a dialog-like process to write or terminate, or for
+        `wakeup' to ask for it to be closed.
+
+        `wakeup' is an object with a fileno() method and a process()
+        method. Each time its file descriptor becomes readable,
+        process() is called; if it returns True the dialog-like
+        process is terminated.
+
+        Return True if the dialog-like process was terminated this
+        way, False if it wrote output or exited by itself.
+
+        """
+        while True:
+            try:
+                ready = select.select([child_rfd, wakeup], [], [])[0]
+            except select.error, v:
+                if v[0] == errno.EINTR:
+                    continue
+                raise PythonDialogOSError(v[1])
+
+            if child_rfd in ready:
+                return False
+
+            if wakeup.process():
+                os.kill(child_pid, signal.SIGTERM)
+                os.waitpid(child_pid, 0)
+                os.close(child_rfd)
+                return True
+
     def _perform(self, cmdargs, **kwargs):
 	"""Perform a complete dialog-like program invocation.
 
@@ -819,14 +849,22 @@ class Dialog:
         termination and returns its exit status and whatever it wrote
         on its standard error stream.
 
+        If a `wakeup' keyword argument is given (see
+        _wait_for_wakeup()), the box may be closed before the user
+        answers; the exit status is None in this case.
+
         Notable exceptions:
 
             any exception raised by self._call_program() or
             self._wait_for_program_termination()
 
         """
+        wakeup = kwargs.pop("wakeup", None)
         (child_pid, child_rfd) = \
                     self._call_program(False, *(cmdargs,), **kwargs)
+        if wakeup is not None and \
+           self._wait_for_wakeup(child_pid, child_rfd, wakeup):
+            return (None, "")
         (exit_code, output) = \
                     self._wait_for_program_termination(child_pid,
                                                         child_rfd)
@@ -10,12 +10,23 @@
 This module contains high-level convenience functions for safe
 command execution that properly escape arguments and raise an
 ExecError exception on error
+
+Commands are either strings, run through /bin/sh, or argv lists
+executed directly without any intermediate shell.
 """
 import os
+import re
 import sys
+import time
+import errno
+import signal
+import resource
 import commands
+import tempfile
+import threading
+import collections
 
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
 
 mkarg = commands.mkarg
 
@@ -24,21 +35,177 @@ class ExecError(Exception):
     command	executed command
     exitcode	non-zero exitcode returned by command
     output	error output returned by command
+    timedout	True if command was killed after exceeding its timeout
     """
-    def __init__(self, command, exitcode, output=None):
+    def __init__(self, command, exitcode, output=None, timedout=False):
         Exception.__init__(self, command, exitcode, output)
 
         self.command = command
         self.exitcode = exitcode
         self.output = output
+        self.timedout = timedout
 
     def __str__(self):
+        command = self.command
+        if isinstance(command, list):
+            command = " ".join(command)
         str = "non-zero exitcode (%d) for command: %s" % (self.exitcode,
-                                                          self.command)
+                                                          command)
         if self.output:
             str += "\n" + self.output
         return str
 
+class Telemetry:
+    """Ring buffer recording the last <size> command executions.
+
+    Each record is a dict with keys command, start, walltime, exitcode,
+    outsize and, when known, utime, stime (child CPU seconds) and maxrss
+    (child peak RSS in KB). Commands run through os.system or a shell only
+    get CPU times accounted from RUSAGE_CHILDREN.
+    """
+    def __init__(self, size=1000):
+        self.records = collections.deque(maxlen=size)
+
+    def record(self, command, start, exitcode, outsize, rusage=None):
+        rec = { 'command': command,
+                'start': start,
+                'walltime': time.time() - start,
+                'exitcode': exitcode,
+                'outsize': outsize,
+                'utime': None,
+                'stime': None,
+                'maxrss': None }
+        if rusage:
+            rec['utime'] = rusage.ru_utime
+            rec['stime'] = rusage.ru_stime
+            rec['maxrss'] = getattr(rusage, 'ru_maxrss', None)
+
+        self.records.append(rec)
+
+    @staticmethod
+    def _command_name(command):
+        """Name under which <command> is summarized: the program run,
+        looking through 'su - user -c' wrappers"""
+        if isinstance(command, str):
+            command = command.split()
+        if not command:
+            return ''
+
+        if os.path.basename(command[0]) == 'su' and '-c' in command[:-1]:
+            command = " ".join(command[command.index('-c') + 1:]).split() or command
+
+        return os.path.basename(command[0].strip('\'"'))
+
+    def summary(self):
+        """Return [(name, count, total walltime, max walltime, cpu time)]
+        sorted by decreasing total walltime"""
+        stats = {}
+        for rec in self.records:
+            name = self._command_name(rec['command'])
+            count, total, longest, cpu = stats.get(name, (0, 0.0, 0.0, 0.0))
+            if rec['utime'] is not None:
+                cpu += rec['utime'] + rec['stime']
+            stats[name] = (count + 1, total + rec['walltime'],
+                           max(longest, rec['walltime']), cpu)
+
+        summary = [ (name,) + stat for name, stat in stats.items() ]
+        summary.sort(key=lambda stat: stat[2], reverse=True)
+        return summary
+
+    def dump(self, path):
+        """Write summary and records to <path>"""
+        fh = file(path, "w")
+        fh.write("# command\tcount\twall(s)\tmax wall(s)\tcpu(s)\n")
+        for stat in self.summary():
+            fh.write("%s\t%d\t%.3f\t%.3f\t%.3f\n" % stat)
+
+        fh.write("\n# cache hits %d misses %d\n" % (cache.hits, cache.misses))
+
+        fh.write("\n# start\twall(s)\texitcode\toutsize\tutime\tstime\tmaxrss\tcommand\n")
+        for rec in self.records:
+            fields = [ time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(rec['start'])),
+                       "%.3f" % rec['walltime'], str(rec['exitcode']), str(rec['outsize']) ]
+            for key in ('utime', 'stime', 'maxrss'):
+                if rec[key] is None:
+                    fields.append('-')
+                else:
+                    fields.append(str(rec[key]))
+            fields.append(re.sub(r'\s+', ' ', str(rec['command'])))
+            fh.write("\t".join(fields) + "\n")
+
+        fh.close()
+
+telemetry = Telemetry()
+
+class _ChildrenUsage:
+    """RUSAGE_CHILDREN CPU times consumed since creation, for commands
+    we can't reap ourselves"""
+    def __init__(self):
+        self.before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    @property
+    def ru_utime(self):
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime - self.before.ru_utime
+
+    @property
+    def ru_stime(self):
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_stime - self.before.ru_stime
+
+def _exitcode(status):
+    """Exit code of a wait() <status>, negative if killed by a signal"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _wait4(child):
+    """Reaps <child> with os.wait4 -> (exitcode, rusage)
+    exitcode is negative if child was killed by a signal"""
+    while True:
+        try:
+            pid, status, rusage = os.wait4(child.pid, 0)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            # already reaped
+            return child.wait(), None
+
+    child.returncode = _exitcode(status)
+    return child.returncode, rusage
+
+def _execve(argv, outfile=None):
+    """Executes <argv> without shell, stderr and stdout going to <outfile>
+    (inherited if None) -> (exitcode, rusage)"""
+    stderr = None
+    if outfile:
+        stderr = STDOUT
+
+    try:
+        child = Popen(argv, stdout=outfile, stderr=stderr, close_fds=True)
+    except OSError, e:
+        if outfile:
+            outfile.write(str(e))
+        return 127, None
+
+    return _wait4(child)
+
+def _communicate(child, input, outfile, errfile):
+    """Feeds <input> to <child> and reaps it. <child> output is spooled
+    to <outfile> and <errfile> -> (exitcode, output, errors, rusage)"""
+    try:
+        if input:
+            child.stdin.write(input)
+        child.stdin.close()
+    except IOError, e:
+        if e.errno != errno.EPIPE:
+            raise
+
+    exitcode, rusage = _wait4(child)
+
+    outfile.seek(0)
+    errfile.seek(0)
+    return exitcode, outfile.read(), errfile.read(), rusage
+
 def system(command, careabouterrors=True):
     """Executes <command>  -> None
     If command returns non-zero exitcode raises ExecError"""
@@ -46,18 +213,38 @@ def system(command, careabouterrors=True):
     sys.stdout.flush()
     sys.stderr.flush()
 
-    error = os.system(command)
-    if error and careabouterrors:
-        exitcode = os.WEXITSTATUS(error)
+    start = time.time()
+    if isinstance(command, list):
+        exitcode, rusage = _execve(command)
+    else:
+        rusage = _ChildrenUsage()
+        exitcode = _exitcode(os.system(command))
+    telemetry.record(command, start, exitcode, 0, rusage)
+
+    if exitcode and careabouterrors:
         raise ExecError(command, exitcode)
 
 def getoutput(command, careabouterrors=True):
     """Executes <command> -> output
     If command returns non-zero exitcode raises ExecError"""
 
-    error, output = commands.getstatusoutput(command)
-    if error and careabouterrors:
-        exitcode = os.WEXITSTATUS(error)
+    start = time.time()
+    if isinstance(command, list):
+        outfile = tempfile.TemporaryFile()
+        exitcode, rusage = _execve(command, outfile)
+        outfile.seek(0)
+        output = outfile.read()
+        # same as commands.getstatusoutput
+        if output[-1:] == "\n":
+            output = output[:-1]
+        telemetry.record(command, start, exitcode, len(output), rusage)
+    else:
+        usage = _ChildrenUsage()
+        status, output = commands.getstatusoutput(command)
+        exitcode = _exitcode(status)
+        telemetry.record(command, start, exitcode, len(output), usage)
+
+    if exitcode and careabouterrors:
         raise ExecError(command, exitcode, output)
 
     return output
@@ -73,19 +260,280 @@ def getoutput_popen(command, careabouterrors=True, input=None):
     if isinstance(command, str):
         shell=True
 
-    child = Popen(command, shell=shell, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    outfile = tempfile.TemporaryFile()
+    errfile = tempfile.TemporaryFile()
+    start = time.time()
+    child = Popen(command, shell=shell, stdin=PIPE, stdout=outfile, stderr=errfile)
+
+    exitcode, outstr, errstr, rusage = _communicate(child, input, outfile, errfile)
+    telemetry.record(command, start, exitcode, len(outstr), rusage)
+
+    if exitcode != 0 and careabouterrors:
+        raise ExecError(command, exitcode, errstr)
 
-    errstr = None
+    return outstr
+
+def _killpg(child):
+    """Kill <child> and every process of its process group"""
     try:
-        outstr, errstr = child.communicate(input)
+        os.killpg(child.pid, signal.SIGKILL)
     except OSError:
         pass
 
-    errno = child.wait()
-    if errstr is None:
-        errstr = child.stderr.read()
+def getoutput_iter(command, careabouterrors=True, input=None, stop=None, timeout=None):
+    """Uses subprocess.Popen to execute <command>, piping <input> into stdin.
+    Yields command output line by line (without newline) as it arrives.
+
+    Only the current line is held in memory, stderr is spooled to a
+    temporary file. If <stop> is given, it is called with each line and
+    the command is killed as soon as it returns True (that line is not
+    yielded). Closing the generator early kills the command too.
 
-    if errno != 0 and careabouterrors:
-        raise ExecError(command, errno, errstr)
+    If command returns non-zero exitcode or runs longer than <timeout>
+    seconds raise ExecError once the output is exhausted.
+    """
 
-    return outstr
+    shell = isinstance(command, str)
+    errfile = tempfile.TemporaryFile()
+    start = time.time()
+    child = Popen(command, shell=shell, stdin=PIPE, stdout=PIPE, stderr=errfile,
+                  close_fds=True, preexec_fn=os.setsid)
+    timedout = []
+    def _expire():
+        timedout.append(True)
+        _killpg(child)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _expire)
+        timer.start()
+
+    stopped = False
+    outsize = 0
+    try:
+        # input is meant to be a few answers to prompts, it fits in the
+        # pipe buffer so it can be written before reading any output
+        if input:
+            child.stdin.write(input)
+        child.stdin.close()
+
+        # readline() rather than file iteration, which reads ahead
+        for line in iter(child.stdout.readline, ''):
+            line = line.rstrip('\n')
+            if stop and stop(line):
+                stopped = True
+                break
+            outsize += len(line) + 1
+            yield line
+        else:
+            child.stdout.close()
+    finally:
+        if timer:
+            timer.cancel()
+        if child.poll() is None and not child.stdout.closed:
+            stopped = True
+            _killpg(child)
+        exitcode, rusage = _wait4(child)
+        telemetry.record(command, start, exitcode, outsize, rusage)
+
+    if stopped or not careabouterrors:
+        return
+
+    errfile.seek(0)
+    if timedout:
+        raise ExecError(command, exitcode, "timed out after %s seconds" % timeout, True)
+    if exitcode != 0:
+        raise ExecError(command, exitcode, errfile.read())
+
+class CommandResult:
+    """Accessible attributes:
+    command	executed command
+    exitcode	exitcode returned by command (negative if killed by a signal)
+    output	standard output returned by command
+    errors	error output returned by command
+    walltime	elapsed time in seconds
+    timedout	True if command was killed after exceeding its timeout
+    """
+    def __init__(self, command, exitcode, output, errors, walltime, timedout=False):
+        self.command = command
+        self.exitcode = exitcode
+        self.output = output
+        self.errors = errors
+        self.walltime = walltime
+        self.timedout = timedout
+
+    def __repr__(self):
+        return "CommandResult(%r, exitcode=%r, walltime=%.3f)" % (self.command,
+                                                                 self.exitcode,
+                                                                 self.walltime)
+
+class Job(threading.Thread):
+    """Executes <command> in a background thread, piping <input> into stdin.
+
+    If <timeout> seconds elapse before the command terminates, its whole
+    process group is killed (so a hung ssh behind a shell dies too).
+    Once joined, the CommandResult is available as job.result.
+    """
+    def __init__(self, command, timeout=None, input=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.command = command
+        self.timeout = timeout
+        self.input = input
+        self.result = None
+        self.slots = None
+        self._timedout = False
+
+    def _kill(self, child):
+        self._timedout = True
+        _killpg(child)
+
+    def run(self):
+        try:
+            shell = isinstance(self.command, str)
+            start = time.time()
+            outfile = tempfile.TemporaryFile()
+            errfile = tempfile.TemporaryFile()
+            try:
+                child = Popen(self.command, shell=shell, stdin=PIPE, stdout=outfile,
+                              stderr=errfile, close_fds=True, preexec_fn=os.setsid)
+            except OSError, e:
+                self.result = CommandResult(self.command, 127, '', str(e),
+                                            time.time() - start)
+                return
+
+            timer = None
+            if self.timeout:
+                timer = threading.Timer(self.timeout, self._kill, [child])
+                timer.start()
+            try:
+                exitcode, output, errors, rusage = _communicate(child, self.input,
+                                                                outfile, errfile)
+            finally:
+                if timer:
+                    timer.cancel()
+
+            telemetry.record(self.command, start, exitcode, len(output), rusage)
+            self.result = CommandResult(self.command, exitcode, output, errors,
+                                        time.time() - start, self._timedout)
+        finally:
+            if self.slots:
+                self.slots.release()
+
+def run_many(commands, concurrency=4, timeout=None):
+    """Executes <commands> concurrently, at most <concurrency> at a time.
+
+    Items are either commands (run with the default <timeout>) or Job
+    instances carrying their own timeout and input.
+
+    Return a list of CommandResult in the same order as <commands>.
+    No exception is raised on failure, check result.exitcode.
+    """
+    jobs = []
+    for command in commands:
+        if not isinstance(command, Job):
+            command = Job(command, timeout)
+        jobs.append(command)
+
+    slots = threading.BoundedSemaphore(concurrency)
+    for job in jobs:
+        slots.acquire()
+        job.slots = slots
+        job.start()
+
+    for job in jobs:
+        job.join()
+
+    return [ job.result for job in jobs ]
+
+class CommandCache:
+    """Memoizes getoutput() of read-only commands for <ttl> seconds.
+
+    Entries are keyed by command (argv lists and strings alike) and at
+    most <maxsize> of them are kept, the least recently used being
+    evicted first. Failing commands raising ExecError are not cached.
+
+    Accessible attributes:
+    ttl		default time to live of an entry, in seconds
+    hits	number of lookups served from the cache
+    misses	number of lookups which executed the command
+    """
+    def __init__(self, ttl=5, maxsize=64):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(command):
+        if isinstance(command, list):
+            return tuple(command)
+        return command
+
+    def _lookup(self, key, ttl):
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[0] >= ttl:
+            return None
+
+        self._tick += 1
+        entry[2] = self._tick
+        return entry
+
+    def _store(self, key, output):
+        if key not in self._entries and len(self._entries) >= self.maxsize:
+            lru = min(self._entries, key=lambda k: self._entries[k][2])
+            del self._entries[lru]
+
+        self._tick += 1
+        self._entries[key] = [time.time(), output, self._tick]
+
+    def getoutput(self, command, careabouterrors=True, ttl=None):
+        """Executes <command> -> output, unless a fresher than <ttl>
+        result is cached. If command returns non-zero exitcode raises
+        ExecError"""
+        if ttl is None:
+            ttl = self.ttl
+
+        key = self._key(command)
+        self._lock.acquire()
+        try:
+            entry = self._lookup(key, ttl)
+            if entry:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        output = getoutput(command, careabouterrors)
+
+        self._lock.acquire()
+        try:
+            self._store(key, output)
+        finally:
+            self._lock.release()
+
+        return output
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+
+cache = CommandCache()
+
+def getoutput_cached(command, careabouterrors=True, ttl=None):
+    """Executes read-only <command> -> output, served from the module
+    cache when it ran less than <ttl> seconds ago"""
+    return cache.getoutput(command, careabouterrors, ttl)
+
+def clear_cache():
+    """To be called after any command that changes system state"""
+    cache.clear()
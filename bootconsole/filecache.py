@@ -0,0 +1,95 @@
+# Copyright (c) 2014 Romain Forlot <romain.forlot@syleps.fr> - all rights reserved
+"""
+This module implements a process-wide cache of parsed files.
+
+A file is parsed again only when its identity or content signature
+(inode, mtime in ns, size) changed since last time, otherwise the
+previous parse result is returned. Results are shared between callers,
+so parsers should return immutable values (or callers copy them).
+
+Usage:
+
+    def parse_lines(path):
+        return tuple(file(path).readlines())
+
+    lines = filecache.parse('/etc/hosts', parse_lines)
+"""
+import os
+import threading
+
+class FileCache:
+    """Accessible attributes:
+    hits	number of parse() served from cache
+    misses	number of parse() which ran the parser
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature(path):
+        """Return (inode, mtime_ns, size) of <path>, raise OSError if
+        it doesn't exist"""
+        st = os.stat(path)
+        return (st.st_ino, int(st.st_mtime * 1000000000), st.st_size)
+
+    def parse(self, path, parser):
+        """Return parser(path), parsing again only if <path> changed"""
+        path = os.path.abspath(path)
+        key = (path, parser)
+        signature = self.signature(path)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        result = parser(path)
+
+        self._lock.acquire()
+        try:
+            self._entries[key] = (signature, result)
+        finally:
+            self._lock.release()
+
+        return result
+
+    def invalidate(self, path=None):
+        """Forget results for <path>, or everything if None.
+        Writers call this since a rewrite within the same mtime tick and
+        with the same size would go unnoticed"""
+        self._lock.acquire()
+        try:
+            if path is None:
+                self._entries = {}
+                return
+
+            path = os.path.abspath(path)
+            for key in self._entries.keys():
+                if key[0] == path:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+cache = FileCache()
+
+def parse(path, parser):
+    return cache.parse(path, parser)
+
+def invalidate(path=None):
+    cache.invalidate(path)
+
+def listdir(path):
+    """Cached os.listdir(), a directory mtime changes with its entries"""
+    return cache.parse(path, _listdir)
+
+def _listdir(path):
+    return tuple(sorted(os.listdir(path)))
@@ -0,0 +1,173 @@
+# Copyright (c) 2014 Romain Forlot <romain.forlot@syleps.fr> - all rights reserved
+
+"""Helpers to write configuration files only when their content changes,
+and to replace several of them atomically"""
+
+import os
+import errno
+import tempfile
+import filecache
+import executil
+
+class Error(Exception):
+    pass
+
+def read(path):
+    """Return the content of path, None if it doesn't exist"""
+    try:
+        fh = file(path)
+    except IOError:
+        return None
+
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+def is_unchanged(path, content):
+    return read(path) == content
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# selinuxfs mount points, /selinux up to EL6
+SELINUXFS = ('/sys/fs/selinux', '/selinux')
+
+def _restorecon(paths):
+    """Give paths their default SELinux context, temporary files being
+    labeled after their directory"""
+    enabled = [ dir for dir in SELINUXFS if os.path.exists(os.path.join(dir, 'enforce')) ]
+    if paths and enabled:
+        executil.getoutput(['restorecon'] + paths, careabouterrors=False)
+
+def _fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Transaction:
+    """Replace a batch of files all at once.
+
+    Each staged file is written to a temporary file in its target
+    directory, then all of them are renamed over their targets and every
+    directory involved is fsynced once. If anything fails, files already
+    renamed get their previous content back. Files whose content is
+    unchanged are not touched at all.
+
+        tx = Transaction()
+        tx.stage('/etc/resolv.conf', content)
+        tx.commit()
+    """
+
+    def __init__(self):
+        # [ (path, new content, old content or None) ]
+        self.staged = []
+        self.unchanged = []
+        self.written = []
+
+    def stage(self, path, content):
+        # write through symlinks (e.g. resolv.conf) instead of replacing them
+        path = os.path.realpath(path)
+        for i, (staged_path, staged_content, old) in enumerate(self.staged):
+            if staged_path == path:
+                self.staged[i] = (path, content, old)
+                return
+
+        self.staged.append((path, content, read(path)))
+
+    def _write_temp(self, path, content):
+        dirname, basename = os.path.split(path)
+        fd, tmppath = tempfile.mkstemp(prefix='.' + basename + '.', dir=dirname)
+        try:
+            try:
+                st = os.stat(path)
+                os.fchmod(fd, st.st_mode & 07777)
+                os.fchown(fd, st.st_uid, st.st_gid)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # mkstemp creates files 0600
+                os.fchmod(fd, 0666 & ~_umask())
+
+            os.write(fd, content)
+            os.fsync(fd)
+        except:
+            os.close(fd)
+            os.unlink(tmppath)
+            raise
+
+        os.close(fd)
+        return tmppath
+
+    def _rollback(self, renamed):
+        for path, old in renamed:
+            try:
+                if old is None:
+                    os.unlink(path)
+                else:
+                    os.rename(self._write_temp(path, old), path)
+            except (IOError, OSError):
+                pass
+
+            filecache.invalidate(path)
+
+        _restorecon([ path for path, old in renamed if old is not None ])
+
+    def commit(self):
+        """Apply staged changes. Return the list of files written"""
+        pending = []
+        self.unchanged = []
+        for path, content, old in self.staged:
+            if content == old:
+                self.unchanged.append(path)
+            else:
+                pending.append((path, content, old))
+
+        temps = []
+        renamed = []
+        try:
+            try:
+                for path, content, old in pending:
+                    temps.append((self._write_temp(path, content), path, old))
+
+                while temps:
+                    tmppath, path, old = temps[0]
+                    os.rename(tmppath, path)
+                    temps.pop(0)
+                    renamed.append((path, old))
+                    filecache.invalidate(path)
+
+                dirs = []
+                for path, old in renamed:
+                    dirname = os.path.dirname(path)
+                    if dirname not in dirs:
+                        dirs.append(dirname)
+                for dirname in dirs:
+                    _fsync_dir(dirname)
+
+                _restorecon([ path for path, old in renamed ])
+
+            except (IOError, OSError), e:
+                self._rollback(renamed)
+                raise Error("could not write configuration, changes rolled back: %s" % e)
+        finally:
+            for tmppath, path, old in temps:
+                try:
+                    os.unlink(tmppath)
+                except OSError:
+                    pass
+
+        self.staged = []
+        self.written = [ path for path, old in renamed ]
+        return self.written
+
+def write_if_changed(path, content):
+    """Atomically replace path with content, unless path already holds
+    exactly that content. Return True if the file was written"""
+    tx = Transaction()
+    tx.stage(path, content)
+    return bool(tx.commit())
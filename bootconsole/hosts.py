@@ -0,0 +1,118 @@
+# Copyright (c) 2014 Romain Forlot <romain.forlot@syleps.fr> - all rights reserved
+
+"""Streaming rewriter for the Syleps managed block of /etc/hosts, and
+index of its entries"""
+
+from collections import namedtuple
+import filecache
+
+BLOCK_BEGIN = "# Syleps configuration"
+BLOCK_END = "# End Syleps"
+
+def rewrite(lines, block):
+    """Yield lines with the managed block replaced by <block>.
+
+    The new block takes the place of the old one, or is appended if there
+    was none. Lines outside of it are left alone, even those declaring a
+    managed name, such as the loopback line:
+
+    >>> list(rewrite(["127.0.0.1 localhost dbsup01\\n",
+    ...               "# Syleps configuration\\n", "old\\n", "# End Syleps\\n"],
+    ...              ["new\\n"]))
+    ['127.0.0.1 localhost dbsup01\\n', 'new\\n']
+    """
+    in_block = False
+    written = False
+    for line in lines:
+        if in_block:
+            if line.startswith(BLOCK_END):
+                in_block = False
+            continue
+
+        if line.startswith(BLOCK_BEGIN):
+            in_block = True
+            if not written:
+                written = True
+                for block_line in block:
+                    yield block_line
+            continue
+
+        if not line.endswith('\n'):
+            line += '\n'
+        yield line
+
+    if not written:
+        for block_line in block:
+            yield block_line
+
+class HostEntry(namedtuple('HostEntry', 'ip names comment')):
+    """One hosts line: ip, declared names (canonical hostname first) and
+    trailing comment, e.g. the LOCAL/PARTNER role of managed entries"""
+    __slots__ = ()
+
+    @property
+    def hostname(self):
+        return self.names[0]
+
+class HostsIndex:
+    """Exact lookups over hosts entries by IP, name (case insensitive)
+    or role comment. When a key is declared several times, the first
+    entry wins, like the resolver"""
+    def __init__(self, lines=()):
+        self.entries = []
+        self.by_ip = {}
+        self.by_name = {}
+        self.by_comment = {}
+        for line in lines:
+            self.add(line)
+
+    @classmethod
+    def from_file(cls, path):
+        fh = file(path)
+        try:
+            return cls(fh)
+        finally:
+            fh.close()
+
+    def add(self, line):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return
+
+        if '#' in line:
+            line, comment = line.split('#', 1)
+            comment = comment.strip()
+        else:
+            comment = ''
+
+        fields = line.split()
+        if len(fields) < 2:
+            return
+
+        entry = HostEntry(fields[0], tuple(fields[1:]), comment)
+        self.entries.append(entry)
+        self.by_ip.setdefault(entry.ip, []).append(entry)
+        for name in entry.names:
+            self.by_name.setdefault(name.lower(), entry)
+        if comment:
+            self.by_comment.setdefault(comment, entry)
+
+    def lookup(self, key):
+        """Return the entry for a role comment, an IP or a name, or None"""
+        if key in self.by_comment:
+            return self.by_comment[key]
+        if key in self.by_ip:
+            return self.by_ip[key][0]
+        return self.by_name.get(key.lower())
+
+    def names(self, ip):
+        """Reverse lookup: every name declared for ip, in file order"""
+        names = []
+        for entry in self.by_ip.get(ip, []):
+            names.extend([ name for name in entry.names if name not in names ])
+        return names
+
+def index(path='/etc/hosts'):
+    """Return the HostsIndex of path, rebuilt only when the file changes.
+    It is shared through filecache, don't modify it"""
+    return filecache.parse(path, HostsIndex.from_file)
@@ -3,12 +3,20 @@
 # Copyright (c) 2014 Romain Forlot <romain.forlot@syleps.fr> - all rights reserved
 
 import os
+import time
+import socket
 import executil
 import netinfo
+import filecache
+import fileutil
+from ipaddr import IPRange
 
 class Error(Exception):
     pass
 
+# seconds request_dhcp() waits for leases, see dhcp_deadline in bootconsole.conf
+DHCP_DEADLINE = 30
+
 class NetworkSettings:
     """class for controlling /etc/sysconfig/network-scripts/ifcfg-ethX
 
@@ -26,6 +34,8 @@ class NetworkSettings:
     TUI_TOOL = '/usr/bin/nmtui'
 
     def __init__(self):
+        # files left untouched by the last set_* call, content was the same
+        self.skipped = []
         self.read_conf()
         # Detect whether or not we can configure network using a tui tool
         try:
@@ -33,32 +43,62 @@ class NetworkSettings:
         except OSError:
             pass
         
+    @classmethod
+    def _parse_ifcfg(self, fname):
+        """Parse an ifcfg file -> (has syleps header, ifname, conf lines,
+        {KEY: value}). The result is shared through filecache, don't
+        modify it"""
+        header = False
+        ifname = None
+        lines = []
+        settings = {}
+        for line in file(fname).readlines():
+            line = line.rstrip()
+
+            if line == self.HEADER_SYLEPS:
+                header = True
+
+            if not line or line.startswith("#"):
+                continue
+
+            if '=' in line:
+                key, value = line.split('=', 1)
+                value = value.strip()
+                if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+                    value = value[1:-1]
+                settings[key.strip()] = value
+
+            if line.startswith("DEVICE"):
+                ifname = settings.get('DEVICE')
+                # DEVICE comes first, whatever its place in the file
+                lines.insert(0, line)
+            else:
+                lines.append(line)
+
+        return header, ifname, "".join([ line + "\n" for line in lines ]), settings
+
     def read_conf(self):
+        """(Re)load ifcfg files. Only files changed since last read are
+        parsed again, see filecache"""
         self.conf = {}
+        self.ifcfg = {}
         self.conf_files = []
-        for _file in os.listdir(self.IFCFG_DIR):
+        for _file in filecache.listdir(self.IFCFG_DIR):
             if _file.startswith('ifcfg-') and not _file.endswith('lo'):
                 self.conf_files.append(_file)
         self.unconfigured = False
 
-        ifname = None
         for ifcfg_file in self.conf_files:
             fname = self.IFCFG_DIR + ifcfg_file
-            for line in file(fname).readlines():
-                line = line.rstrip()
-
-                if line == self.HEADER_SYLEPS:
-                    self.unconfigured = True
+            header, ifname, conf, settings = filecache.parse(fname, self._parse_ifcfg)
 
-                if not line or line.startswith("#"):
-                    continue
+            if header:
+                self.unconfigured = True
 
-                if line.startswith("DEVICE"):
-                    ifname = line.split('=')[1]
-                    ifname = ifname.strip('"')
-                    self.conf[ifname] = line + "\n"
-                elif ifname:
-                    self.conf[ifname] += line + "\n"
+            if ifname:
+                self.conf[ifname] = conf
+                # own copy, the parsed dict is shared through filecache
+                self.ifcfg[ifname] = dict(settings)
 
     def _get_iface_opts(self, ifname):
         iface_opts = ('pre-up', 'up', 'post-up', 'pre-down', 'down', 'post-down')
@@ -70,26 +110,42 @@ class NetworkSettings:
                  for line in ifconf.splitlines()
                  if line.strip().split()[0] in iface_opts ]
 
-    def write_conf(self, filename, conf):
-        self.read_conf()
-        
-        fh = file(filename, "w")
-        fh.write(self.HEADER_SYLEPS+'\n')
-        fh.write(self.WARN_SYLEPS+'\n')
-        fh.write("\n")
-        fh.write(conf+'\n')
+    def _render(self, conf):
+        return "%s\n%s\n\n%s\n" % (self.HEADER_SYLEPS, self.WARN_SYLEPS, conf)
 
-        fh.close()
+    def write_conf(self, filename, conf):
+        """Write conf to filename, unless it is already there.
+        Return True if the file was written"""
+        return self.write_confs([(filename, conf)])
+
+    def write_confs(self, confs):
+        """Atomically write [ (filename, conf) ], see fileutil.Transaction.
+        Return True if any file was written"""
+        tx = fileutil.Transaction()
+        for filename, conf in confs:
+            tx.stage(filename, self._render(conf))
+
+        written = tx.commit()
+        self.skipped.extend(tx.unchanged)
+        return bool(written)
     
     def _filepath_assembler(self, ifname):
         return self.IFCFG_DIR+"ifcfg-"+ifname
 
-    def set_dhcp(self, ifname):
-        filepath = self._filepath_assembler(ifname)
-        ifconf = "DEVICE=%s\nBOOTPROTO=dhcp\nONBOOT=yes" % (ifname)
-        self.write_conf(filepath, ifconf)
+    def set_dhcp(self, *ifnames):
+        self.skipped = []
+        confs = []
+        for ifname in ifnames:
+            filepath = self._filepath_assembler(ifname)
+            ifconf = "DEVICE=%s\nBOOTPROTO=dhcp\nONBOOT=yes" % (ifname)
+            confs.append((filepath, ifconf))
+
+        return self.write_confs(confs)
 
     def set_static(self, ifname, addr, netmask, gateway=None, nameservers=[None, None], search_domain=None):
+        """Write ifcfg, network and resolv.conf files.
+        Return True if any of them changed"""
+        self.skipped = []
         filepath = self._filepath_assembler(ifname)
         
         ifconf = ["DEVICE=%s" % ifname,
@@ -118,11 +174,12 @@ class NetworkSettings:
         ifconf = "\n".join(ifconf)
         networkconf = "\n".join(networkconf)
         resolvconf = "\n".join(resolvconf)
-        self.write_conf(filepath, ifconf)
-        self.write_conf(self.NETWORK_FILE, networkconf)
-        self.write_conf(self.RESOLV_FILE, resolvconf)
+        return self.write_confs([(filepath, ifconf),
+                                 (self.NETWORK_FILE, networkconf),
+                                 (self.RESOLV_FILE, resolvconf)])
 
     def set_hostname(self, hostname):
+        self.skipped = []
         fh = file(self.NETWORK_FILE, 'r')
         networkconf = []
         for line in fh.readlines():
@@ -134,65 +191,114 @@ class NetworkSettings:
         networkconf.append("HOSTNAME=%s" % hostname)
         networkconf = "".join(networkconf)
 
-        self.write_conf(self.NETWORK_FILE, networkconf)
-        executil.system("hostnamectl set-hostname %s" % hostname)
+        changed = self.write_conf(self.NETWORK_FILE, networkconf)
+        if not changed and socket.gethostname() == hostname:
+            self.skipped.append("hostnamectl set-hostname")
+            return False
+
+        executil.system(["hostnamectl", "set-hostname", hostname])
+        executil.clear_cache()
+        return True
 
 
 class NetworkInterface:
     """Enumerate interface information from /etc/sysconfig/network-scripts/ifcfg-*"""
 
-    def __init__(self, ifname):
+    def __init__(self, ifname, networksettings=None):
         self.ifname = ifname
+        # whether the last set_static changed anything, what it skipped
+        self.changed = True
+        self.skipped = []
 
-        self.networksettings = NetworkSettings()
-
-        self.conflines = []
-        if ifname in self.networksettings.conf:
-            self.conflines = self.networksettings.conf[ifname].splitlines()
-
-    def _parse_attr(self, attr):
-        for line in self.conflines:
-
-            vals = line.strip().split('=')
-            if not vals:
-                continue
-
-            if vals[0] == attr:
-                return vals
-
-        return []
-
-    def __getattr__(self, attrname):
-        #attributes with multiple values will be returned in an array
-        #exception: dns-nameservers always returns in array (expected)
-
-        attrname = attrname.replace('_', '-')
-        values = self._parse_attr(attrname)
-        if len(values) > 2:
-            return values[1:]
-        elif len(values) > 1:
-            return values[1]
+        if networksettings is None:
+            networksettings = NetworkSettings()
+        self.networksettings = networksettings
 
-        return
+        # KEY -> value of ifcfg-<ifname>
+        self.settings = self.networksettings.ifcfg.get(ifname, {})
 
-    def set_dhcp(self):
+    def set_dhcp(self, deadline=None, progress=None, monitor=None):
         try:
-            self.ifdown()
-            self.networksettings.set_dhcp(self.ifname)
-            output = self.ifup()
-
-            addr = netinfo.SysInterfaceInfo(self.ifname).address
+            leases = request_dhcp([self.ifname], deadline, progress, monitor,
+                                  self.networksettings)
+            addr, output = leases[self.ifname]
             if not addr:
                 raise Error('Error obtaining IP address\n\n%s' % output)
 
         except Exception, e:
             return str(e)
 
+    def _live_changes(self, addr, netmask, gateway):
+        """Return the ip commands bringing the running interface to
+        addr/netmask/gateway, or None when only a full ifdown/ifup
+        will do (interface down or not statically configured yet).
+
+        The new address is added before the old one is removed and the
+        default route is replaced in place, so established sessions
+        survive when the address doesn't change."""
+        info = netinfo.SysInterfaceInfo(self.ifname)
+        if self.method != 'static' or not info.is_up:
+            return None
+
+        cur_addr, cur_netmask, cur_gateway = info.address, info.netmask, info.gateway
+        if not cur_addr:
+            return None
+
+        changes = []
+        if (cur_addr, cur_netmask) != (addr, netmask):
+            changes.append(['ip', 'addr', 'add', IPRange(addr, netmask).fmt_cidr(),
+                            'brd', '+', 'dev', self.ifname])
+            changes.append(['ip', 'addr', 'del', IPRange(cur_addr, cur_netmask).fmt_cidr(),
+                            'dev', self.ifname])
+            # removing the old address drops the routes through it
+            cur_gateway = None
+
+        if gateway and gateway != cur_gateway:
+            changes.append(['ip', 'route', 'replace', 'default', 'via', gateway,
+                            'dev', self.ifname])
+        elif not gateway and cur_gateway:
+            changes.append(['ip', 'route', 'del', 'default', 'dev', self.ifname])
+
+        return changes
+
+    def _apply_live(self, changes):
+        # Keep the new address if it is in the same subnet as the old
+        # one and thus added as a secondary address
+        fh = file('/proc/sys/net/ipv4/conf/%s/promote_secondaries' % self.ifname, 'w')
+        fh.write('1')
+        fh.close()
+
+        try:
+            for argv in changes:
+                executil.getoutput(argv)
+        finally:
+            executil.clear_cache()
+
     def set_static(self, addr, netmask, gateway, nameservers, hostname):
         try:
-            self.ifdown()
-            self.networksettings.set_static(self.ifname, addr, netmask, gateway, nameservers, hostname)
-            output = self.ifup()
+            changes = self._live_changes(addr, netmask, gateway)
+            if changes:
+                try:
+                    self._apply_live(changes)
+                except (executil.ExecError, IOError):
+                    changes = None
+
+            # ifdown has to read the configuration the interface was
+            # brought up with, so it runs before the new one is written
+            if changes is None:
+                self.ifdown()
+
+            written = self.networksettings.set_static(self.ifname, addr, netmask, gateway, nameservers, hostname)
+
+            self.skipped = list(self.networksettings.skipped)
+            self.changed = written or changes != []
+            if not self.changed:
+                self.skipped.append("%s restart" % self.ifname)
+                return
+
+            output = ''
+            if changes is None:
+                output = self.ifup()
 
             addr = netinfo.SysInterfaceInfo(self.ifname).address
             if not addr:
@@ -205,41 +311,131 @@ class NetworkInterface:
         try:
             self.ifdown()
             self.networksettings.set_manual(self.ifname)
-            executil.system("ifconfig %s 0.0.0.0" % self.ifname)
+            executil.system(["ifconfig", self.ifname, "0.0.0.0"])
+            executil.clear_cache()
             self.ifup()
         except Exception, e:
             return str(e)
 
     def ifup(self):
-        return executil.getoutput("ifup %s"% self.ifname)
+        try:
+            return executil.getoutput(["ifup", self.ifname])
+        finally:
+            executil.clear_cache()
 
     def ifdown(self):
-        return executil.getoutput("ifdown %s"% self.ifname)
+        try:
+            return executil.getoutput(["ifdown", self.ifname])
+        finally:
+            executil.clear_cache()
 
     @property
     def method(self):
-        try:
-            return self._parse_attr('BOOTPROTO')[1]
-        except IndexError:
-            return
+        return self.settings.get('BOOTPROTO')
 
     @property
     def macaddr(self):
-        return self._parse_attr('HWADDR')[1]
+        return self.settings.get('HWADDR')
 
     @property
     def dns_nameservers(self):
-        return self._parse_attr('dns-nameservers')[1:]
+        nameservers = []
+        i = 1
+        while 'DNS%d' % i in self.settings:
+            nameservers.append(self.settings['DNS%d' % i])
+            i += 1
+        return nameservers
 
     def __getattr__(self, attrname):
-        #attributes with multiple values will be returned in an array
-        #exception: dns-nameservers always returns in array (expected)
+        # ifcfg keys, ie: iface.ipaddr or iface.IPADDR -> IPADDR value
+        if attrname.startswith('__'):
+            raise AttributeError(attrname)
+
+        settings = self.__dict__.get('settings', {})
+        return settings.get(attrname, settings.get(attrname.upper()))
+
 
-        attrname = attrname.replace('_', '-')
-        values = self._parse_attr(attrname)
-        if len(values) > 2:
-            return values[1:]
-        elif len(values) > 1:
-            return values[1]
+def request_dhcp(ifnames, deadline=None, progress=None, monitor=None,
+                 networksettings=None):
+    """Configure <ifnames> for DHCP and bring them up in parallel.
+
+    Leases are awaited from netlink notifications (on <monitor> if given,
+    see netinfo.NetworkMonitor) until every interface has an address or
+    <deadline> seconds elapse, at which point ifup processes still running
+    are killed. progress(percent, text) is called while waiting.
+
+    Return {ifname: (address or None, ifup output)}
+    """
+    if deadline is None:
+        deadline = DHCP_DEADLINE
+    if networksettings is None:
+        networksettings = NetworkSettings()
+    if monitor is None:
+        try:
+            monitor = netinfo.NetworkMonitor()
+        except socket.error:
+            pass
 
-        return
\ No newline at end of file
+    # ifdown has to read the configuration the interfaces were brought
+    # up with, so it runs before the DHCP one is written
+    executil.run_many([ ["ifdown", ifname] for ifname in ifnames ],
+                      concurrency=len(ifnames), timeout=deadline)
+    executil.clear_cache()
+    networksettings.set_dhcp(*ifnames)
+    if monitor:
+        # forget the addresses ifdown just removed
+        monitor.process()
+
+    jobs = {}
+    for ifname in ifnames:
+        jobs[ifname] = executil.Job(["ifup", ifname], timeout=deadline)
+        jobs[ifname].start()
+
+    start = time.time()
+    running = jobs.values()
+    while True:
+        if monitor:
+            snapshot = monitor.snapshot
+        else:
+            snapshot = netinfo.NetworkInfo().snapshot()
+
+        addresses = {}
+        for ifname in ifnames:
+            iface = snapshot.get(ifname)
+            if iface and iface.address:
+                addresses[ifname] = iface.address
+
+        elapsed = time.time() - start
+        if progress:
+            lines = []
+            for ifname in ifnames:
+                lines.append("%s: %s" % (ifname, addresses.get(ifname, "waiting for lease...")))
+            percent = max(100 * len(addresses) / len(ifnames),
+                          int(100 * elapsed / deadline))
+            progress(min(percent, 100), "\n".join(lines))
+
+        if len(addresses) == len(ifnames) or elapsed >= deadline or not running:
+            break
+
+        # one more look once all ifup are done, their last events may be pending
+        running = [ job for job in running if job.isAlive() ]
+        timeout = min(0.5, deadline - elapsed)
+        if monitor:
+            monitor.process(timeout)
+        else:
+            time.sleep(timeout)
+
+    executil.clear_cache()
+
+    leases = {}
+    for ifname in ifnames:
+        result = jobs[ifname].result
+        if result is not None:
+            output = result.output + result.errors
+        elif ifname in addresses:
+            output = ''
+        else:
+            output = "no lease after %s seconds" % deadline
+        leases[ifname] = (addresses.get(ifname), output)
+
+    return leases
@@ -1,9 +1,31 @@
 # Copyright (c) 2009 Liraz Siri <liraz@turnkeylinux.org> - all rights reserved
 
+import sys
 import string
 import struct
 import socket
 import math
+from array import array
+
+def _aton(ip):
+    """dotted quad -> 4 bytes in network order, None if illegal"""
+    try:
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (socket.error, TypeError):
+        pass
+
+    # inet_pton refuses leading zeros, which we always read as decimal
+    try:
+        octets = ip.split('.')
+    except AttributeError:
+        return None
+    if len(octets) != 4 or not [ octet for octet in octets if octet.isdigit() ] == octets:
+        return None
+
+    try:
+        return struct.pack("BBBB", *map(int, octets))
+    except struct.error:
+        return None
 
 def _str2int(ip):
     bytes = map(int, ip.split('.'))
@@ -45,19 +67,7 @@ class IP(long):
 
     @staticmethod
     def is_legal(ip):
-        try:
-            if len([ octet for octet in ip.split(".") 
-                    if 255 >= int(octet) >= 0 ]) != 4:
-                return False
-        except ValueError:
-            return False
-    
-        try:
-            packed = socket.inet_aton(ip)
-        except socket.error:
-            return False
-    
-        return True
+        return _aton(ip) is not None
 
     __add__ = _numeric_method("__add__")
     __sub__ = _numeric_method("__sub__")
@@ -89,3 +99,176 @@ class IPRange:
         return "%s/%d" % (self.ip, self.cidr)
 
     __str__ = fmt_cidr
+
+class IPArray:
+    """Compact array of IPv4 addresses, stored as native unsigned 32 bit
+    integers (array('I')) instead of one IP object each.
+
+    Parsing validates and converts every address in a single pass and
+    formatting converts them all at once, so large hosts files, routing
+    or neighbour tables are cheap to handle.
+    """
+    TYPECODE = 'I'
+
+    def __init__(self, addresses=()):
+        """addresses: integers, or another IPArray"""
+        if isinstance(addresses, IPArray):
+            addresses = addresses.array
+        self.array = array(self.TYPECODE, addresses)
+
+    @classmethod
+    def parse(cls, strings, errors=None):
+        """Build from dotted quads. Illegal addresses raise Error, unless
+        an <errors> list is given to collect them"""
+        packed = []
+        for ip in strings:
+            bytes = _aton(ip)
+            if bytes is None:
+                if errors is None:
+                    raise Error("illegal ip (%s)" % ip)
+                errors.append(ip)
+            else:
+                packed.append(bytes)
+
+        ips = cls()
+        ips.array.fromstring(''.join(packed))
+        if sys.byteorder == 'little':
+            ips.array.byteswap()
+        return ips
+
+    def format(self):
+        """Return the addresses as a list of dotted quads"""
+        a = array(self.TYPECODE, self.array)
+        if sys.byteorder == 'little':
+            a.byteswap()
+        packed = a.tostring()
+        ntoa = socket.inet_ntoa
+        return [ ntoa(packed[i:i+4]) for i in xrange(0, len(packed), 4) ]
+
+    def sorted(self):
+        return IPArray(sorted(self.array))
+
+    def unique(self):
+        """Return sorted addresses without duplicates"""
+        return IPArray(sorted(set(self.array)))
+
+    def mask(self, iprange):
+        """Return a list of booleans, True where the address is in
+        iprange (same semantic as IPRange.__contains__)"""
+        network = long(iprange.network)
+        broadcast = long(iprange.broadcast)
+        return [ network < ip < broadcast for ip in self.array ]
+
+    def within(self, iprange):
+        """Return the addresses which are in iprange"""
+        network = long(iprange.network)
+        broadcast = long(iprange.broadcast)
+        return IPArray([ ip for ip in self.array if network < ip < broadcast ])
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return (IP(ip) for ip in self.array)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return IPArray(self.array[i])
+        return IP(self.array[i])
+
+    def __contains__(self, ip):
+        return long(IP(ip)) in self.array
+
+    def __eq__(self, other):
+        return isinstance(other, IPArray) and self.array == other.array
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "IPArray.parse(%r)" % self.format()
+
+class PrefixTree:
+    """Longest prefix match over IPRange prefixes carrying a payload
+    (a route, an interface...), in at most 32 steps whatever the number
+    of prefixes. Unlike IPRange.__contains__, the network and broadcast
+    addresses of a prefix match it.
+
+        tree = PrefixTree()
+        tree.insert(IPRange.from_cidr('10.0.0.0/8'), 'eth0')
+        tree.lookup('10.1.2.3') -> (IPRange('10.0.0.0', '255.0.0.0'), 'eth0')
+    """
+    # node slots
+    ZERO, ONE, PREFIX, PAYLOAD = range(4)
+
+    def __init__(self):
+        self.root = [None, None, None, None]
+        self.size = 0
+
+    def insert(self, iprange, payload):
+        """Attach payload to iprange, replacing any previous one"""
+        network = long(iprange.network)
+        node = self.root
+        for bit in xrange(31, 31 - iprange.cidr, -1):
+            branch = (network >> bit) & 1
+            if node[branch] is None:
+                node[branch] = [None, None, None, None]
+            node = node[branch]
+
+        if node[self.PREFIX] is None:
+            self.size += 1
+        node[self.PREFIX] = IPRange(iprange.network, iprange.netmask)
+        node[self.PAYLOAD] = payload
+
+    def lookup(self, ip):
+        """Return (iprange, payload) of the longest prefix holding ip,
+        or None"""
+        ip = long(IP(ip))
+        node = self.root
+        match = None
+        bit = 31
+        while node is not None:
+            if node[self.PREFIX] is not None:
+                match = node
+            if bit < 0:
+                break
+            node = node[(ip >> bit) & 1]
+            bit -= 1
+
+        if match is None:
+            return None
+        return match[self.PREFIX], match[self.PAYLOAD]
+
+    def __len__(self):
+        return self.size
+
+def benchmark(count=100000):
+    """Compare IPArray with per object IP on <count> addresses"""
+    import time
+    import random
+
+    strings = [ "10.%d.%d.%d" % (random.randint(0, 255), random.randint(0, 255),
+                                 random.randint(0, 255))
+                for i in xrange(count) ]
+    iprange = IPRange.from_cidr("10.128.0.0/9")
+
+    start = time.time()
+    ips = [ IP(ip) for ip in strings if IP.is_legal(ip) ]
+    inrange = [ ip for ip in ips if ip in iprange ]
+    unique = sorted(set(ips))
+    formatted = [ str(ip) for ip in unique ]
+    per_object = time.time() - start
+
+    start = time.time()
+    ips = IPArray.parse(strings, errors=[])
+    inrange = ips.within(iprange)
+    unique = ips.unique()
+    formatted = unique.format()
+    vectorized = time.time() - start
+
+    print "%d addresses: parse, filter in %s, dedupe, format" % (count, iprange)
+    print "  IP:      %.3f s" % per_object
+    print "  IPArray: %.3f s" % vectorized
+
+if __name__ == "__main__":
+    benchmark()
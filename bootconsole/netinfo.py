@@ -8,18 +8,29 @@
 # License, or (at your option) any later version.
 
 import re
+import errno
+import select
 
+import array
 import struct
 import socket
 import fcntl
+from collections import namedtuple
 
-import executil
+import filecache
+from ipaddr import IPRange, PrefixTree
 from lazyclass import lazyclass
 
 SIOCGIFFLAGS = 0x8913
 SIOCGIFADDR = 0x8915 
 SIOCGIFNETMASK = 0x891b 
 SIOCGIFBRDADDR = 0x8919
+SIOCGIFCONF = 0x8912
+SIOCGIFMTU = 0x8921
+SIOCGIFHWADDR = 0x8927
+
+# sizeof(struct ifreq)
+IFREQ_SIZE = 16 + 2 * struct.calcsize('P') + 8
 
 IFF_UP = 0x1           # interface is up
 IFF_BROADCAST = 0x2    # vald broadcast address
@@ -40,6 +51,24 @@ IFF_DYNAMIC = 0x8000L  # addr's lost on inet down
 IFF_LOWER_UP = 0x10000 # has netif_dormant_on()
 IFF_DORMANT = 0x20000  # has netif_carrier_on()
 
+RTF_UP = 0x0001        # route usable
+RTF_GATEWAY = 0x0002   # destination is a gateway
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+NLMSG_HDRLEN = 16
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+IFLA_IFNAME = 3
+IFA_LABEL = 3
+
 
 class Error(Exception):
     pass
@@ -84,7 +113,7 @@ class NetworkInfo:
         return ifnames
 
     @staticmethod
-    def parse_resolv(path):
+    def _parse_resolv(path):
         nameservers = []
         search_domain = ''
         for line in file(path).readlines():
@@ -92,7 +121,12 @@ class NetworkInfo:
                 nameservers.append(line.strip().split()[1])
             if line.startswith('search'):
                 search_domain = line.strip().split()[1]
-        return nameservers, search_domain
+        return tuple(nameservers), search_domain
+
+    @classmethod
+    def parse_resolv(self, path):
+        nameservers, search_domain = filecache.parse(path, self._parse_resolv)
+        return list(nameservers), search_domain
 
     def get_domain(self):
         nameservers, search_domain = self.parse_resolv('/etc/resolv.conf')
@@ -112,6 +146,349 @@ class NetworkInfo:
     def hostname(self):
         return socket.gethostname()
 
+    @staticmethod
+    def get_ifaddrs():
+        """ returns {ifname: address} of interfaces having an IPv4 address,
+        fetched at once with SIOCGIFCONF """
+        maxifs = 128
+        while True:
+            buf = array.array('B', '\0' * (maxifs * IFREQ_SIZE))
+            ifconf = struct.pack('iP', len(buf), buf.buffer_info()[0])
+            size = struct.unpack('iP', fcntl.ioctl(SysInterfaceInfo.sockfd.fileno(),
+                                                   SIOCGIFCONF, ifconf))[0]
+            # a full buffer may have been truncated
+            if size < len(buf):
+                break
+            maxifs *= 2
+
+        ifaddrs = {}
+        data = buf.tostring()
+        for offset in range(0, size, IFREQ_SIZE):
+            ifname = data[offset:offset+16].split('\0', 1)[0]
+            if ifname not in ifaddrs:
+                ifaddrs[ifname] = socket.inet_ntoa(data[offset+20:offset+24])
+
+        return ifaddrs
+
+    @staticmethod
+    def _interface_snapshot(ifname, ifaddrs, routes, method):
+        """ returns InterfaceSnapshot of ifname or None if it vanished """
+        info = SysInterfaceInfo(ifname, check=False)
+        try:
+            flags = info.flags
+        except IOError:
+            return None
+
+        return InterfaceSnapshot(ifname, flags, ifaddrs.get(ifname),
+                                 info.netmask, info.broadcast, info.macaddr,
+                                 info.mtu, routes.gateway(ifname), method)
+
+    def snapshot(self):
+        """ returns a NetworkSnapshot of every interface, collected in one pass """
+        import ifutil
+
+        ifaddrs = self.get_ifaddrs()
+        routes = RoutingTable()
+        settings = ifutil.NetworkSettings()
+        nameservers, domain = self.parse_resolv('/etc/resolv.conf')
+
+        interfaces = []
+        for ifname in self.get_ifnames():
+            iface = self._interface_snapshot(ifname, ifaddrs, routes,
+                                             ifutil.NetworkInterface(ifname, settings).method)
+            if iface:
+                interfaces.append(iface)
+
+        return NetworkSnapshot(tuple(interfaces), tuple(nameservers), domain,
+                               self.hostname)
+
+class InterfaceSnapshot(namedtuple('InterfaceSnapshot',
+                                   'ifname flags address netmask broadcast '
+                                   'macaddr mtu gateway method')):
+    """ state of a single interface at snapshot time """
+
+    @property
+    def is_up(self):
+        return (self.flags & IFF_UP) != 0
+
+    @property
+    def is_loopback(self):
+        return (self.flags & IFF_LOOPBACK) != 0
+
+class NetworkSnapshot(namedtuple('NetworkSnapshot',
+                                 'interfaces nameservers domain hostname')):
+    """ immutable state of all interfaces, see NetworkInfo.snapshot() """
+
+    @property
+    def ifnames(self):
+        return [ iface.ifname for iface in self.interfaces ]
+
+    def get(self, ifname):
+        """ returns InterfaceSnapshot of ifname or None """
+        for iface in self.interfaces:
+            if iface.ifname == ifname:
+                return iface
+
+        return None
+
+    def get_ipconf(self, ifname):
+        """ same as SysInterfaceInfo(ifname).get_ipconf() """
+        iface = self.get(ifname)
+        if iface is None:
+            return None, None, None, list(self.nameservers), self.domain
+
+        return iface.address, iface.netmask, iface.gateway, list(self.nameservers), self.domain
+
+class NetworkMonitor(object):
+    """
+    keep a NetworkSnapshot up to date from rtnetlink notifications
+    (links, IPv4 addresses and IPv4 routes), without polling.
+
+    Usage:
+
+        monitor = NetworkMonitor()
+        # select() on monitor (it has a fileno), then
+        if monitor.process():
+            redraw(monitor.snapshot)
+    """
+
+    GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+
+    def __init__(self, groups=GROUPS):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, groups))
+        self.sock.setblocking(0)
+
+        self.callbacks = []
+        self.snapshot = NetworkInfo().snapshot()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def subscribe(self, callback):
+        """ callback(snapshot) is called whenever the snapshot changes """
+        self.callbacks.append(callback)
+
+    @staticmethod
+    def _parse_attr(data, offset, end, wanted):
+        """ returns value of rtattr wanted found in data[offset:end] """
+        while offset + 4 <= end:
+            length, type = struct.unpack('HH', data[offset:offset+4])
+            if length < 4:
+                break
+            if type == wanted:
+                return data[offset+4:offset+length].split('\0', 1)[0]
+            offset += (length + 3) & ~3
+
+        return None
+
+    @classmethod
+    def parse(cls, data):
+        """ returns (routes_changed, links_changed, ifnames) from netlink
+        messages in data. links_changed means interfaces appeared or
+        disappeared, ifnames are the interfaces whose state changed """
+        routes_changed = False
+        links_changed = False
+        ifnames = set()
+
+        offset = 0
+        while offset + NLMSG_HDRLEN <= len(data):
+            length, type = struct.unpack('IH', data[offset:offset+6])
+            if length < NLMSG_HDRLEN:
+                break
+            end = offset + length
+            payload = offset + NLMSG_HDRLEN
+
+            if type in (RTM_NEWROUTE, RTM_DELROUTE):
+                routes_changed = True
+            elif type in (RTM_NEWLINK, RTM_DELLINK):
+                # struct ifinfomsg is 16 bytes
+                ifname = cls._parse_attr(data, payload + 16, end, IFLA_IFNAME)
+                if type == RTM_DELLINK or ifname is None:
+                    links_changed = True
+                else:
+                    ifnames.add(ifname)
+            elif type in (RTM_NEWADDR, RTM_DELADDR):
+                # struct ifaddrmsg is 8 bytes, label is ifname[:alias]
+                label = cls._parse_attr(data, payload + 8, end, IFA_LABEL)
+                if label is None:
+                    links_changed = True
+                else:
+                    ifnames.add(label.split(':', 1)[0])
+
+            offset += (length + 3) & ~3
+
+        return routes_changed, links_changed, ifnames
+
+    def _read(self):
+        """ returns pending notifications, '' if there are none """
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.sock.recv(65536))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                # ENOBUFS: notifications were lost, resync everything
+                if e.args[0] == errno.ENOBUFS:
+                    return None
+                raise
+
+        return ''.join(chunks)
+
+    def _update(self, routes_changed, ifnames):
+        """ returns snapshot with ifnames (and gateways) refreshed """
+        snapshot = self.snapshot
+        ifaddrs = NetworkInfo.get_ifaddrs()
+        routes = RoutingTable()
+
+        interfaces = []
+        for iface in snapshot.interfaces:
+            if iface.ifname in ifnames:
+                iface = NetworkInfo._interface_snapshot(iface.ifname, ifaddrs, routes,
+                                                        iface.method)
+                if iface is None:
+                    continue
+            elif routes_changed:
+                iface = iface._replace(gateway=routes.gateway(iface.ifname))
+            interfaces.append(iface)
+
+        return snapshot._replace(interfaces=tuple(interfaces))
+
+    def process(self, timeout=0):
+        """ wait up to timeout seconds (None: forever) for notifications
+        and apply them -> True if the snapshot changed """
+        try:
+            ready = select.select([self.sock], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        if not ready:
+            return False
+
+        data = self._read()
+        if data is None:
+            snapshot = NetworkInfo().snapshot()
+        else:
+            routes_changed, links_changed, ifnames = self.parse(data)
+            if links_changed or [ ifname for ifname in ifnames
+                                  if ifname not in self.snapshot.ifnames ]:
+                snapshot = NetworkInfo().snapshot()
+            elif routes_changed or ifnames:
+                snapshot = self._update(routes_changed, ifnames)
+            else:
+                return False
+
+        if snapshot == self.snapshot:
+            return False
+
+        self.snapshot = snapshot
+        for callback in self.callbacks:
+            callback(snapshot)
+
+        return True
+
+def _hex2ip(value):
+    """convert a /proc/net/route address (hex, host byte order)"""
+    return socket.inet_ntoa(struct.pack('=L', int(value, 16)))
+
+class Route(object):
+    """a single /proc/net/route entry
+
+    Accessible attributes:
+    ifname	output interface
+    destination	destination network
+    netmask	destination netmask
+    gateway	next hop, 0.0.0.0 for on-link routes
+    flags	RTF_* flags
+    metric	route metric, lower is preferred
+    mtu		route mtu, 0 if unset
+    """
+    def __init__(self, ifname, destination, gateway, flags, metric, netmask, mtu):
+        self.ifname = ifname
+        self.destination = destination
+        self.gateway = gateway
+        self.flags = flags
+        self.metric = metric
+        self.netmask = netmask
+        self.mtu = mtu
+
+    @property
+    def is_default(self):
+        return self.destination == '0.0.0.0' and self.netmask == '0.0.0.0'
+
+    @property
+    def is_up(self):
+        return (self.flags & RTF_UP) != 0
+
+    @property
+    def is_onlink(self):
+        """destination is reached directly, not through a gateway"""
+        return (self.flags & RTF_GATEWAY) == 0
+
+    def __repr__(self):
+        return "Route(%s/%s via %s dev %s metric %d)" % (self.destination, self.netmask,
+                                                       self.gateway, self.ifname,
+                                                       self.metric)
+
+class RoutingTable(object):
+    """IPv4 main routing table read from /proc/net/route"""
+
+    PROC_ROUTE = '/proc/net/route'
+
+    def __init__(self, path=PROC_ROUTE):
+        self.routes = []
+        for line in file(path).readlines()[1:]:
+            fields = line.split()
+            if len(fields) < 11:
+                continue
+
+            ifname, destination, gateway, flags = fields[:4]
+            metric, netmask, mtu = fields[6:9]
+            self.routes.append(Route(ifname, _hex2ip(destination), _hex2ip(gateway),
+                                     int(flags, 16), int(metric), _hex2ip(netmask),
+                                     int(mtu)))
+
+    def routes_for(self, ifname):
+        """ returns routes going through ifname """
+        return [ route for route in self.routes if route.ifname == ifname ]
+
+    def default_routes(self, ifname=None):
+        """ returns usable default routes, preferred first """
+        routes = [ route for route in self.routes
+                   if route.is_default and route.is_up and
+                      (ifname is None or route.ifname == ifname) ]
+        routes.sort(key=lambda route: route.metric)
+        return routes
+
+    def gateway(self, ifname=None):
+        """ returns preferred default gateway (of ifname) or None """
+        for route in self.default_routes(ifname):
+            if route.flags & RTF_GATEWAY:
+                return route.gateway
+
+        return None
+
+    def prefix_tree(self):
+        """ returns an ipaddr.PrefixTree of usable routes, the preferred
+        one (lowest metric) for each destination """
+        tree = PrefixTree()
+        routes = [ route for route in self.routes if route.is_up ]
+        routes.sort(key=lambda route: route.metric, reverse=True)
+        for route in routes:
+            tree.insert(IPRange(route.destination, route.netmask), route)
+
+        return tree
+
+    def route_to(self, ip):
+        """ returns the Route used to reach ip, or None if unreachable """
+        match = self.prefix_tree().lookup(ip)
+        if match is None:
+            return None
+
+        return match[1]
+
 class SysInterfaceInfo(object):
     """
     enumerate network related configurations
@@ -140,8 +517,8 @@ class SysInterfaceInfo(object):
 
         raise AttributeError("no such attribute: " + attrname)
 
-    def __init__(self, ifname):
-        if ifname not in NetworkInfo().get_ifnames():
+    def __init__(self, ifname, check=True):
+        if check and ifname not in NetworkInfo().get_ifnames():
             raise Error("no such interface '%s'" % ifname)
 
         self.ifname = ifname
@@ -159,12 +536,16 @@ class SysInterfaceInfo(object):
         return socket.inet_ntoa(result[20:24])
 
     def _get_ioctl_flag(self, magic):
+        return (self.flags & magic) != 0
+
+    @property
+    def flags(self):
         result = self._get_ioctl(SIOCGIFFLAGS)
-        flags = struct.unpack('H', result[16:18])[0]
-        return (flags & magic) != 0
+        return struct.unpack('H', result[16:18])[0]
 
     def get_ipconf(self):
-        return self.address, self.netmask, self.gateway, NetworkInfo().get_nameservers(), NetworkInfo().get_domain()
+        nameservers, search_domain = NetworkInfo.parse_resolv('/etc/resolv.conf')
+        return self.address, self.netmask, self.gateway, nameservers, search_domain
 
     @property
     def address(self):
@@ -175,15 +556,30 @@ class SysInterfaceInfo(object):
         return self._get_ioctl_addr(SIOCGIFNETMASK)
 
     @property
-    def gateway(self):
+    def broadcast(self):
+        return self._get_ioctl_addr(SIOCGIFBRDADDR)
+
+    @property
+    def macaddr(self):
         try:
-            output = executil.getoutput("route -n")
-        except executil.ExecError:
+            result = self._get_ioctl(SIOCGIFHWADDR)
+        except IOError:
             return None
 
-        for line in output.splitlines():
-            m = re.search('^0.0.0.0\s+(.*?)\s+(.*)\s+%s' % self.ifname, line, re.M)
-            if m:
-                return m.group(1)
+        return ':'.join([ '%02x' % ord(c) for c in result[18:24] ])
 
-        return None
+    @property
+    def mtu(self):
+        try:
+            result = self._get_ioctl(SIOCGIFMTU)
+        except IOError:
+            return None
+
+        return struct.unpack('i', result[16:20])[0]
+
+    @property
+    def gateway(self):
+        try:
+            return RoutingTable().gateway(self.ifname)
+        except IOError:
+            return None
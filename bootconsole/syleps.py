@@ -28,6 +28,9 @@ class Syleps:
     and configuration files integrity.
     '''
 
+    # Seconds to wait for sqlplus, opatch or the ssh peer before giving up
+    QUERY_TIMEOUT = 120
+
     def __init__(self, bootconsole_conf=Conf('bootconsole.conf')):
         self.bootconsole_conf = bootconsole_conf
         self.var_dir = bootconsole_conf.get_param('var_dir')
@@ -104,15 +107,19 @@ class Syleps:
             return False
     
     def get_SU_version(self, peer_host, component):
-        pre_cmd = 'su - %s -c \'' % self.su_user
-        SU_version_cmd = 'sqlplus $ORACLE_USER/$ORACLE_PASSWD << EOF | grep -E "^[0-9]+"\nselect su_bas_get_version_std from dual;\nEOF\n\''
-        SU_env_cmd = 'sqlplus $ORACLE_USER/$ORACLE_PASSWD << EOF | grep -E "^Config"\nselect lib_cfg_appli from su_cfg_appli where etat_actif=\'1\';\nEOF\n\''
+        pre_cmd = ['su', '-', self.su_user, '-c']
+        SU_version_cmd = 'sqlplus $ORACLE_USER/$ORACLE_PASSWD << EOF | grep -E "^[0-9]+"\nselect su_bas_get_version_std from dual;\nEOF\n'
+        SU_env_cmd = 'sqlplus $ORACLE_USER/$ORACLE_PASSWD << EOF | grep -E "^Config"\nselect lib_cfg_appli from su_cfg_appli where etat_actif=\'1\';\nEOF\n'
         
-        try:
-            SU = { 'version' : executil.getoutput('%s%s' % (pre_cmd,SU_version_cmd)),
-                   'env' : executil.getoutput('%s%s' % (pre_cmd,SU_env_cmd)),
+        # Both sqlplus sessions are independent, run them side by side
+        version, env = executil.run_many([pre_cmd + [SU_version_cmd],
+                                          pre_cmd + [SU_env_cmd]],
+                                         timeout=Syleps.QUERY_TIMEOUT)
+        if version.exitcode == 0 and env.exitcode == 0:
+            SU = { 'version' : version.output.rstrip('\n'),
+                   'env' : env.output.rstrip('\n'),
             }
-        except executil.ExecError:
+        else:
             SU = { 'version' : 'No SU detected',
                    'env' : 'No SU detected',
             }
@@ -161,15 +168,48 @@ class Syleps:
             if opatch_cmd.startswith('Error'):
                 return opatch_cmd
         
-        # Make awk cmd to extract only products installed, except Examples products.
+        # Extract only products installed, except Examples products.
         begin_pattern = 'Installed Top-level Products'
         end_pattern = 'There are [0-9]+ products installed in this Oracle Home'
+        # The peer inventory is filtered remotely with awk so that only the
+        # product list goes through ssh.
         awk_cmd = 'awk \'/%s/{f=1;next} /%s/ {f=0} f && ! /^$/ && ! /Example/ {print}\'' % (begin_pattern, end_pattern)
-        
-        products = [ executil.getoutput_popen('su - %s -c "%s lsinv" | %s' % (users[0], opatch_cmd, awk_cmd), input='\n\n').split('\n'),
-                    executil.getoutput_popen('ssh -o StrictHostKeyChecking=no root@%s "su - %s -c \'opatch lsinv\' | %s"' % (peer_host, users[1], awk_cmd), input='\n\n').split('\n')
-                   ]
-        return products
+
+        # Local and peer inventories are independent, query them side by side
+        peer_job = executil.Job(['ssh', '-o', 'StrictHostKeyChecking=no', 'root@%s' % peer_host,
+                                 "su - %s -c 'opatch lsinv' | %s" % (users[1], awk_cmd)],
+                                timeout=Syleps.QUERY_TIMEOUT, input='\n\n')
+        peer_job.start()
+
+        # The local inventory is streamed and filtered here, we stop reading
+        # as soon as the end of the products list shows up.
+        local_products = []
+        local_timeout = None
+        try:
+            in_products = False
+            for line in executil.getoutput_iter(['su', '-', users[0], '-c', '%s lsinv' % opatch_cmd],
+                                                input='\n\n', timeout=Syleps.QUERY_TIMEOUT,
+                                                stop=re.compile(end_pattern).search):
+                if begin_pattern in line:
+                    in_products = True
+                elif in_products and line and not 'Example' in line:
+                    local_products.append(line)
+        except executil.ExecError, e:
+            # reported like a peer timeout below, other errors go up
+            if not e.timedout:
+                raise
+            local_timeout = e
+        finally:
+            peer_job.join()
+
+        result = peer_job.result
+        for query in (local_timeout, result):
+            if query and query.timedout:
+                return "Error: '%s' did not answer within %d seconds." % (query.command, Syleps.QUERY_TIMEOUT)
+        if result.exitcode != 0:
+            raise executil.ExecError(result.command, result.exitcode, result.errors)
+
+        return [ local_products, result.output.split('\n') ]
         
     @staticmethod
     def _is_syleps_compliant(hostname):   
@@ -290,7 +330,7 @@ class Syleps:
             pass
         
         try:
-            executil.system('/bin/su '+ self.su_user +' - -c "~'+self.su_user+'/run/bin/change_hostname.sh" > /dev/null 2>&1')
+            executil.getoutput(['/bin/su', self.su_user, '-', '-c', '~'+self.su_user+'/run/bin/change_hostname.sh'])
         except executil.ExecError:
             return 'Error: When execute change_hostname.sh script.\nMay be user %s doesn\'t exists or wrong component configured or script is missing.\n Execute it manually and see what\'s going wrong.\nSU password has not been changed.' % self.su_user
 